@@ -1,11 +1,16 @@
 import streamlit as st
 import pandas as pd
 from datetime import datetime
-import yaml
-import io
-import openpyxl
+from contextlib import contextmanager
 from streamlit_sortables import sort_items
-from utils import load_customer_data, optimize_route, calculate_schedule, get_distance_matrix, haversine
+from utils import get_config, calculate_schedule, create_excel, create_excel_multi, excel_bytes, build_today_df, \
+    route_locations, straight_line_matrix, route_distance, reschedule, route_lower_bound, optimality_gap, matrix_legs
+from planner import plan_by_group
+from route_jobs import submit_optimization, fingerprint, apply_order, stop_key, invalidate
+from geocoding import geocode
+from master_store import load_master, list_snapshots, rollback
+from route_links import route_map_urls
+import metrics
 
 # ページ設定
 st.set_page_config(page_title="自販機訪問管理表作成アプリ", layout="wide")
@@ -72,18 +77,32 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# 設定読み込み
-def load_config():
-    with open('config.yaml', 'r', encoding='utf-8') as f:
-        return yaml.safe_load(f)
+# 設定読み込み（utils 側でプロセス内1回だけ読み込まれる）
+CONFIG = get_config()
+metrics.configure_from_config()
 
-CONFIG = load_config()
+# 工程ごとの計測を診断パネル用に集める（顧客名・住所は metrics 側で除外される）
+MAX_DIAGNOSTICS = 300
+
+def add_diagnostics(action, records):
+    for record in records:
+        record['action'] = action
+    st.session_state['diagnostics'] = (st.session_state.get('diagnostics', []) + records)[-MAX_DIAGNOSTICS:]
+
+@contextmanager
+def diagnostics(action):
+    records = []
+    try:
+        with metrics.collect(records):
+            yield
+    finally:
+        add_diagnostics(action, records)
 
 # セッション状態の初期化
 if 'master_df' not in st.session_state:
     st.session_state['master_df'] = pd.DataFrame()
 if 'today_list' not in st.session_state:
-    st.session_state['today_list'] = [] # list of dicts
+    st.session_state['today_list'] = [] # list of {'row': マスタの行ラベル, 'MUST': bool, 'WorkMinutes': int}
 if 'optimized_route' not in st.session_state:
     st.session_state['optimized_route'] = [] # list of dicts (customer data)
 if 'sort_performed' not in st.session_state:
@@ -105,40 +124,145 @@ lunch_end = st.sidebar.time_input("昼休憩終了", value=datetime.strptime(CON
 
 api_key = st.sidebar.text_input("G-Maps 認証情報", value=CONFIG['google_maps_api_key'], help="Google Maps APIキーを入力してください")
 
+# 起点・終点の座標（住所・APIキーが変わった時だけ解決する。解決結果は geocoding.py でファイルにキャッシュ）
+depot_key = (origin_address, destination_address, api_key)
+if st.session_state.get('depot', {}).get('key') != depot_key:
+    with diagnostics("起点・終点の解決"):
+        origin_latlng, origin_error = geocode(origin_address, api_key=api_key)
+        destination_latlng, destination_error = geocode(destination_address, api_key=api_key)
+    st.session_state['depot'] = {
+        'key': depot_key,
+        'origin': origin_latlng,
+        'destination': destination_latlng,
+        'errors': [e for e in (origin_error, destination_error) if e],
+    }
+depot = st.session_state['depot']
+for error in dict.fromkeys(depot['errors']):
+    st.sidebar.error(error)
+if depot['origin'] and depot['destination']:
+    st.sidebar.caption(f"起点: {depot['origin'][0]:.6f}, {depot['origin'][1]:.6f} / "
+                       f"終点: {depot['destination'][0]:.6f}, {depot['destination'][1]:.6f}")
+
 # メインレイアウト
 st.title("自販機訪問管理表作成アプリ (MVP)")
 
+# マスタから作る選択肢（並び順ごとの行ラベルと表示名）はマスタが変わった時だけ作る
+def master_options(master_df):
+    cached = st.session_state.get('master_options')
+    if cached is None or cached['master'] is not master_df:
+        cached = {
+            'master': master_df,
+            # 表示名を工夫: "コード : 名称 (¥売上)"
+            'labels': {row: f"{code} : {name} (¥{int(sales):,})"
+                       for row, code, name, sales in zip(master_df.index, master_df['code'], master_df['name'], master_df['sales'])},
+            'コード順': master_df['code'].sort_values(kind='stable').index.tolist(),
+            '売上見込順': master_df['sales'].sort_values(ascending=False, kind='stable').index.tolist(),
+        }
+        st.session_state['master_options'] = cached
+    return cached
+
+# マスタの差し替え時は、表示名を変更・追加された行だけ作り直す
+def update_master_options(master_df, diff):
+    cached = st.session_state.get('master_options')
+    if cached is None:
+        return
+    labels = dict(cached['labels'])
+    for row in diff['removed']:
+        labels.pop(row, None)
+    for row in diff['changed'] + diff['added']:
+        code, name, sales = master_df.at[row, 'code'], master_df.at[row, 'name'], master_df.at[row, 'sales']
+        labels[row] = f"{code} : {name} (¥{int(sales):,})"
+    st.session_state['master_options'] = {
+        'master': master_df,
+        'labels': labels,
+        'コード順': master_df['code'].sort_values(kind='stable').index.tolist(),
+        '売上見込順': master_df['sales'].sort_values(ascending=False, kind='stable').index.tolist(),
+    }
+
+# TODAYリストを入れ替えた時に呼ぶ（data_editor の編集状態を新しいリストに持ち越さない）
+def today_list_replaced(today_list):
+    st.session_state['today_list'] = today_list
+    st.session_state['today_version'] = st.session_state.get('today_version', 0) + 1
+    st.session_state['sort_performed'] = False
+
+
+# 新しいマスタに差し替える
+# 変わらない顧客は行ラベルが引き継がれるので、TODAYリストは削除された顧客だけを外す。
+# 座標が変わった顧客を含む距離行列・並び替え結果は捨てる
+def replace_master(df, diff):
+    moved = [stop_key(code) for code in df.loc[diff['moved'], 'code']]
+    st.session_state['master_df'] = df
+    st.session_state['master_diff'] = diff
+    update_master_options(df, diff)
+
+    today_list = st.session_state['today_list']
+    kept = [item for item in today_list if item['row'] in df.index]
+    if len(kept) != len(today_list):
+        today_list_replaced(kept)
+    route_matrix = st.session_state.get('route_matrix')
+    if route_matrix is not None and set(moved) & set(route_matrix['codes']):
+        st.session_state['route_matrix'] = None
+        st.session_state['sort_performed'] = False
+    invalidate(moved)
+    return len(today_list) - len(kept)
+
+def diff_summary(diff):
+    return f"追加 {len(diff['added'])}件・削除 {len(diff['removed'])}件・変更 {len(diff['changed'])}件"
+
 # ファイルアップロード
 uploaded_file = st.file_uploader("顧客マスタをアップロード (Excel/CSV)", type=['xlsx', 'csv'])
 
 if uploaded_file is not None:
-    # 毎回読み込むと重いので、ファイルが変わった時だけ読み込む制御を入れたいが
-    # MVPではシンプルに読み込む（あるいは前回と同じならスキップ）
-    # ここでは簡易実装として再読込
-    df, error = load_customer_data(uploaded_file)
-    if error:
-        st.error(error)
-    else:
-        st.session_state['master_df'] = df
-        st.success(f"{len(df)}件の顧客データを読み込みました。")
+    # ファイルが変わった時だけ読み込む（前回のマスタと顧客コードで突き合わせる）
+    if st.session_state.get('master_file_id') != uploaded_file.file_id:
+        with diagnostics("アップロード"):
+            df, diff, error = load_master(uploaded_file, previous=st.session_state['master_df'], warn=st.warning)
+        if error:
+            st.error(error)
+        else:
+            dropped = replace_master(df, diff)
+            st.session_state['master_file_id'] = uploaded_file.file_id
+            if dropped:
+                st.warning(f"マスタから削除された{dropped}件をTODAYリストから外しました。")
+    if st.session_state.get('master_file_id') == uploaded_file.file_id:
+        diff = st.session_state.get('master_diff')
+        detail = f"（前回から {diff_summary(diff)}）" if diff and len(diff['added']) < len(st.session_state['master_df']) else ""
+        st.success(f"{len(st.session_state['master_df'])}件の顧客データを読み込みました。{detail}")
 
-# 2ペイン構成
-col1, col2 = st.columns([1, 1])
+# 保存済みのマスタの版（比較・巻き戻し）。今のマスタと同じ持ち主の版だけを出す
+current = st.session_state.get('master_diff') or {}
+snapshots = list_snapshots(current['master_source']) if current.get('master_source') else []
+if snapshots:
+    with st.expander("マスタの履歴"):
+        versions = {s['version']: s for s in snapshots}
+        version = st.selectbox("版", list(versions),
+                               format_func=lambda v: f"{v}（{versions[v]['rows']}件・追加 {versions[v].get('added', 0)}"
+                                                     f"・削除 {versions[v].get('removed', 0)}・変更 {versions[v].get('changed', 0)}）")
+        if version == current.get('version'):
+            st.caption("現在のマスタです。")
+        elif st.button("この版に戻す"):
+            with diagnostics("マスタの巻き戻し"):
+                df, diff = rollback(version, st.session_state['master_df'])
+            if df is None:
+                st.error("この版は削除されています。")
+            else:
+                dropped = replace_master(df, diff)
+                st.success(f"{version} の版に戻しました（{diff_summary(diff)}）。"
+                           + (f" TODAYリストから{dropped}件を外しました。" if dropped else ""))
 
-with col1:
+# 各ペインは fragment にして、ペイン内の操作ではそのペインだけを再実行する
+# （TODAYリストの編集でマスタ表の描画やアップロード処理を繰り返さない）
+@st.fragment
+def master_panel():
     st.header("① 顧客リスト")
     if not st.session_state['master_df'].empty:
         # リスト欄が狭いという要望に対応し、データフレームを表示して視認性を高める
-        st.dataframe(st.session_state['master_df'], height=300)
-        
-        filtered_df = st.session_state['master_df'].copy()
+        master_df = st.session_state['master_df']
+        st.dataframe(master_df, height=300)
+        options = master_options(master_df)
         
-        # 並び替え処理
+        # 並び替え処理（マスタは複製せず、並び順の行ラベルを使う）
         sort_option = st.radio("並び替え", ["コード順", "売上見込順"], horizontal=True)
-        if sort_option == "売上見込順":
-            filtered_df = filtered_df.sort_values(by='sales', ascending=False)
-        else:
-            filtered_df = filtered_df.sort_values(by='code', ascending=True)
         
         # 選択用リスト表示
         # streamlit-sortablesを使うには、リスト形式で渡す必要がある
@@ -146,43 +270,93 @@ with col1:
         # D&DはSortablesだと「並び替え」には強いが、「2つのリスト間の移動」は標準コンポーネントのみでは少し複雑なため
         
         # マルチセレクトで代用（検索と相性が良い）
-        # 表示名を工夫: "コード : 名称 (¥売上)"
-        options = filtered_df.apply(lambda x: f"{x['code']} : {x['name']} (¥{x['sales']:,})", axis=1).tolist()
-        selected_items = st.multiselect("訪問候補の選択", options, placeholder="ここから追加したい顧客を選択してください")
+        # 選択肢はマスタの行ラベル
+        selected_rows = st.multiselect("訪問候補の選択", options[sort_option], format_func=options['labels'].get,
+                                       placeholder="ここから追加したい顧客を選択してください")
         
         if st.button("TODAYリストへ追加"):
-            current_codes = [item['code'] for item in st.session_state['today_list']]
+            today_list = list(st.session_state['today_list'])
+            current_rows = [item['row'] for item in today_list]
             added_count = 0
-            for item_str in selected_items:
-                code = item_str.split(' : ')[0]
-                if code not in current_codes:
-                    if len(st.session_state['today_list']) >= CONFIG['defaults']['max_today_items']:
+            for row in selected_rows:
+                if row not in current_rows:
+                    if len(today_list) >= CONFIG['defaults']['max_today_items']:
                         st.warning(f"30件の上限に達しました。")
                         break
                     
-                    row = st.session_state['master_df'][st.session_state['master_df']['code'].astype(str) == code].iloc[0]
-                    item_dict = row.to_dict()
-                    item_dict['MUST'] = False # MUSTフラグ初期化
-                    st.session_state['today_list'].append(item_dict)
+                    # 行の参照だけを持つ（MUSTフラグ初期化）
+                    today_list.append({'row': row, 'MUST': False})
                     added_count += 1
             
             if added_count > 0:
-                st.session_state['sort_performed'] = False # リスト変更時は再ソートが必要
+                today_list_replaced(today_list) # リスト変更時は再ソートが必要
                 st.success(f"{added_count}件追加しました。")
                 st.rerun()
 
-with col2:
+
+# 訪問予定のプレビュー用の距離行列
+# 自動並び替えで取得した行列（session_state['route_matrix']）が今の訪問先・起点・終点を全て含めばそれを使い、
+# 含まなければ直線距離の行列を作ってセッションに保持する（どちらも API は呼ばない）
+def preview_matrix(df_today, settings):
+    codes = [stop_key(code) for code in df_today['code']]
+    cached = st.session_state.get('route_matrix')
+    if cached is None or cached['origin'] != settings['origin'] or cached['destination'] != settings['destination'] \
+            or not set(codes) <= set(cached['codes']):
+        locations, end_index = route_locations(settings['origin'], df_today['lat'], df_today['lng'], settings['destination'])
+        dist_matrix, time_matrix = straight_line_matrix(locations)
+        cached = {'codes': codes, 'dist_matrix': dist_matrix, 'time_matrix': time_matrix, 'end_index': end_index,
+                  'origin': settings['origin'], 'destination': settings['destination'],
+                  'lower_bound': route_lower_bound(dist_matrix, end_index), 'solve_ms': None,
+                  'optimized_codes': None, 'source': '直線距離'}
+        st.session_state['route_matrix'] = cached
+    index = {code: i + 1 for i, code in enumerate(cached['codes'])}
+    return cached, [index[code] for code in codes]
+
+
+# 今の並び順での到着・終了時刻と総移動距離（行列を引くだけの O(n)）
+def schedule_preview(df_today, settings):
+    matrix, order = preview_matrix(df_today, settings)
+    rows, summary = reschedule(order, matrix['dist_matrix'], matrix['time_matrix'],
+                               df_today['WorkMinutes'], df_today['NoEntryTime'],
+                               settings['departure'], settings['lunch_start'], settings['lunch_end'],
+                               end_index=matrix['end_index'])
+    summary['source'] = matrix['source']
+    summary['solve_ms'] = matrix['solve_ms']
+    summary['delta_km'] = None
+    summary['lower_bound_km'] = None
+    summary['gap_pct'] = None
+    # 下界（Held-Karp）は行列の全地点で計算しているので、訪問先が行列と同じ時だけ表示する
+    if len(order) == len(matrix['codes']):
+        summary['lower_bound_km'] = round(matrix['lower_bound'] / 1000, 1)
+        summary['gap_pct'] = optimality_gap(route_distance(order, matrix['dist_matrix'], matrix['end_index']),
+                                            matrix['lower_bound'])
+    # 自動並び替えの結果（同じ訪問先の集合）との差
+    if matrix['optimized_codes'] is not None and sorted(matrix['optimized_codes']) == sorted(stop_key(c) for c in df_today['code']):
+        index = {code: i + 1 for i, code in enumerate(matrix['codes'])}
+        optimized_km = route_distance([index[c] for c in matrix['optimized_codes']], matrix['dist_matrix'],
+                                      matrix['end_index']) / 1000
+        summary['delta_km'] = round(summary['distance_km'] - optimized_km, 1)
+    return rows, summary
+
+
+@st.fragment
+def today_panel(settings):
     st.header("② TODAYリスト")
     
     if st.session_state['today_list']:
         # リスト編集機能（data_editor）
-        df_today = pd.DataFrame(st.session_state['today_list'])
+        df_today = build_today_df(st.session_state['master_df'], st.session_state['today_list'])
+        
+        # ドラッグで訪問順を手動変更（要件定義書 5.3）
+        with st.expander("訪問順を手動で変更（ドラッグ）"):
+            labels = [f"{code} : {name}" for code, name in zip(df_today['code'], df_today['name'])]
+            sorted_labels = sort_items(labels, key=f"today_sortable_{st.session_state.get('today_version', 0)}")
+            if sorted_labels != labels and sorted(sorted_labels) == sorted(labels):
+                by_label = dict(zip(labels, st.session_state['today_list']))
+                today_list_replaced([by_label[label] for label in sorted_labels])
+                # このペインだけを再実行する（サイドバー・アップロード・マスタ表は描き直さない）
+                st.rerun(scope="fragment")
         
-        # 列の並び順と表示設定
-        # 必須列があるか確認
-        if 'MUST' not in df_today.columns:
-            df_today['MUST'] = False
-            
         # 表示したい列を定義
         display_cols = ['MUST', 'code', 'name', 'sales', 'WorkMinutes', 'NoEntryTime', 'address', 'lat', 'lng']
         # 存在しない列は除外
@@ -197,163 +371,367 @@ with col2:
                 "code": "コード",
                 "name": "顧客名",
                 "sales": st.column_config.NumberColumn("売上見込", format="¥%d"),
-                "WorkMinutes": st.column_config.NumberColumn("作業時間(分)", min_value=1, step=1, help="作業時間を編集できます"),
+                "WorkMinutes": st.column_config.NumberColumn("作業時間(分)", min_value=1, step=1, required=True,
+                                                             help="作業時間を編集できます"),
                 "NoEntryTime": "入場不可",
                 "address": "住所"
             },
             disabled=["code", "name", "sales", "NoEntryTime", "address", "lat", "lng"],
             hide_index=True,
             use_container_width=True,
-            key="today_editor"
+            key=f"today_editor_{st.session_state.get('today_version', 0)}"
         )
         
         # 編集結果をsession_stateに反映
         # 行の削除等はdata_editorでは標準で「削除」機能があるが、ここでは編集結果をそのままリストに戻す
         # 注意: 削除機能有効化には num_rows="dynamic" が必要
         
-        # data_editorの結果はDataFrameなので、辞書リストに戻してsession_stateを更新
-        # ただしrerunループを防ぐため、比較する？ -> data_editorは編集時にrerunするので、ここで代入してOK
-        st.session_state['today_list'] = edited_df.to_dict('records')
+        # data_editorの結果から MUST・作業時間だけを TODAYリスト（行の参照）に戻す
+        # data_editorは編集時にこの fragment だけを再実行するので、ここで代入してOK
+        # 空欄にされた作業時間はマスタの値に戻す
+        master_work = st.session_state['master_df']['WorkMinutes'].loc[df_today['row']].to_numpy()
+        work_minutes = pd.to_numeric(edited_df['WorkMinutes'], errors='coerce').fillna(
+            pd.Series(master_work, index=edited_df.index)).round().astype(int).to_numpy()
+        st.session_state['today_list'] = [
+            {'row': item['row'], 'MUST': bool(must), 'WorkMinutes': int(work)}
+            for item, must, work in zip(st.session_state['today_list'], edited_df['MUST'], work_minutes)
+        ]
+
+        # 今の並び順・作業時間での予定（並び替え・作業時間の編集のたびに再計算。API は呼ばない）
+        if settings['origin'] and settings['destination']:
+            df_today['WorkMinutes'] = work_minutes
+            rows, summary = schedule_preview(df_today, settings)
+            st.dataframe(
+                pd.DataFrame({
+                    'code': df_today['code'],
+                    'name': df_today['name'],
+                    'arrival_time': [r['arrival_time'].strftime('%H:%M') for r in rows],
+                    'finish_time': [r['finish_time'].strftime('%H:%M') for r in rows],
+                    'travel_min': [r['travel_min'] for r in rows],
+                    'travel_dist': [r['travel_dist'] for r in rows],
+                }),
+                column_config={
+                    "code": "コード",
+                    "name": "顧客名",
+                    "arrival_time": "到着",
+                    "finish_time": "終了",
+                    "travel_min": "移動(分)",
+                    "travel_dist": "移動(km)",
+                },
+                hide_index=True,
+                use_container_width=True
+            )
+            col_m1, col_m2, col_m3 = st.columns(3)
+            col_m1.metric(f"総移動距離（{summary['source']}）", f"{summary['distance_km']:.1f} km")
+            col_m2.metric("帰着予定", summary['end_time'].strftime('%H:%M'))
+            if summary['delta_km'] is not None:
+                col_m3.metric("自動並び替えとの差", f"{summary['delta_km']:+.1f} km",
+                              delta=f"{summary['delta_km']:+.1f} km", delta_color="inverse")
+            if summary['gap_pct'] is not None:
+                solve = f"・自動並び替えの計算 {summary['solve_ms']:.0f} ms" if summary['solve_ms'] is not None else ""
+                st.caption(f"最適性ギャップ: {summary['gap_pct']:.1f}% 以内"
+                           f"（下界 {summary['lower_bound_km']:.1f} km に対する今の並び順の超過{solve}）")
 
         # 削除ボタン（一括削除など）
         if st.button("全クリア"):
-            st.session_state['today_list'] = []
-            st.session_state['sort_performed'] = False
+            today_list_replaced([])
             st.rerun()
     
     # 合計売上見込の計算（data_editor反映後に計算）
-    total_sales = sum([int(item.get('sales', 0)) for item in st.session_state['today_list']])
+    today_rows = [item['row'] for item in st.session_state['today_list']]
+    total_sales = int(st.session_state['master_df']['sales'].loc[today_rows].sum()) if today_rows else 0
     st.metric("合計売上見込", f"¥{total_sales:,}")
 
 
-# アクションエリア
-st.markdown("---")
-st.header("アクション")
+# 並び替えジョブの結果を TODAYリストに反映する
+def apply_route_job(job):
+    notices = [('warning', message) for message in job.warnings]
+    add_diagnostics("自動並び替え", job.records)
+    job.records = []
+    if job.cancelled:
+        notices.append(('info', "並び替えをキャンセルしました。"))
+    elif job.future.exception() is not None:
+        notices.append(('error', f"並び替えに失敗しました: {job.future.exception()}"))
+    else:
+        df_today = build_today_df(st.session_state['master_df'], st.session_state['today_list'])
+        if fingerprint(df_today, *job.inputs) != job.key:
+            # 実行中に TODAYリストが変更された
+            notices.append(('warning', "並び替え中に TODAYリストが変更されたため、結果を破棄しました。"))
+        else:
+            result = job.result()
+            today_list_replaced(apply_order(st.session_state['today_list'], df_today['code'], result['order']))
+            st.session_state['sort_performed'] = True # ソート完了フラグ
+            # 取得した行列は手動並び替え時のプレビューに使う
+            st.session_state['route_matrix'] = {
+                **result,
+                'origin': job.inputs[0],
+                'destination': job.inputs[2],
+                'optimized_codes': result['order'],
+                'source': '距離行列',
+            }
+            notices.append(('success', "最短ルート順に並び替えました！" + ("（前回の結果を再利用）" if job.cached else "")))
+    st.session_state['route_job_notices'] = notices
+    st.session_state['route_job'] = None
 
-if st.session_state.get('sort_performed'):
-    st.info("💡 **並び替えが完了しました！** 次に右側の **『訪問予定表(Excel)作成』** ボタンをクリックしてファイルを **作成** してください。")
 
-col_a, col_b = st.columns(2)
+# 実行中の並び替えジョブの進捗表示（0.5秒ごとにこの fragment だけを再実行）
+@st.fragment(run_every=0.5)
+def route_job_panel():
+    job = st.session_state.get('route_job')
+    if job is None:
+        return
+    if job.done():
+        apply_route_job(job)
+        st.rerun()
 
-with col_a:
-    if st.button("自動並び替え (距離順)", type="primary"):
-        if not st.session_state['today_list']:
-            st.warning("TODAYリストが空です。")
-        else:
-            with st.spinner("ルート計算中..."):
-                # 起点の座標取得（簡易的に固定値あるいはAPIでジオコーディングが必要）
-                # 今回はMVPなので設定ファイルのデフォルト住所に対応する座標をハードコード、あるいはAPIがあるならAPIを使う
-                # ここでは「千葉県市原市白金町1-32」の座標を一時的に使用（サンプルに合わせる）
-                # 35.534222, 140.111557 (サンプル参照) -> 実際には住所から取るべきだが
-                origin_lat, origin_lng = 35.534222, 140.111557 # 仮
-                
-                # ルート最適化ロジック呼び出し
-                # locationsリスト作成 (index 0 は起点)
-                locations = [{'lat': origin_lat, 'lng': origin_lng}] + \
-                            [{'lat': item['lat'], 'lng': item['lng']} for item in st.session_state['today_list']]
-                
-                # 距離行列
-                dist_matrix, _ = get_distance_matrix(locations, api_key=api_key)
+    progress = job.progress
+    if progress['stage'] == 'matrix' and progress['total']:
+        st.progress(0.8 * progress['done'] / progress['total'],
+                    text=f"距離行列を取得中... {progress['done']}/{progress['total']}")
+    elif progress['stage'] == 'optimize':
+        st.progress(0.9, text=f"並び替え中...（2-opt {progress['done']}周目）")
+    else:
+        st.progress(0.0, text="ルート計算の順番待ち...")
+    if st.button("キャンセル", key="cancel_route_job"):
+        job.cancel()
+
+
+@st.fragment
+def actions_panel(settings):
+    st.header("アクション")
+
+    for level, message in st.session_state.pop('route_job_notices', []):
+        getattr(st, level)(message)
+
+    if st.session_state.get('sort_performed'):
+        st.info("💡 **並び替えが完了しました！** 次に右側の **『訪問予定表(Excel)作成』** ボタンをクリックしてファイルを **作成** してください。")
+
+    col_a, col_b = st.columns(2)
+
+    with col_a:
+        if st.session_state.get('route_job') is not None:
+            route_job_panel()
+        elif st.button("自動並び替え (距離順)", type="primary"):
+            if not st.session_state['today_list']:
+                st.warning("TODAYリストが空です。")
+            elif not settings['origin'] or not settings['destination']:
+                st.warning("起点・終点の座標を取得できません。サイドバーの住所・APIキーを確認してください。")
+            else:
+                # 距離行列の取得と並び替えはバックグラウンドで実行する（route_jobs.py）
+                # 同じ内容で並び替え済みならキャッシュから即座に返る
+                df_today = build_today_df(st.session_state['master_df'], st.session_state['today_list'])
+                job = submit_optimization(df_today, settings['origin'], settings['departure'], api_key=settings['api_key'],
+                                          destination=settings['destination'])
+                if job.done():
+                    apply_route_job(job)
+                else:
+                    st.session_state['route_job'] = job
+                st.rerun()
+
+    with col_b:
+        if st.session_state.get('sort_performed'):
+            st.markdown('<div class="pulse-btn">', unsafe_allow_html=True)
+            
+        if st.button("訪問予定表 (Excel) 作成"):
+            if not st.session_state['today_list']:
+                st.warning("リストが空です")
+            elif not settings['origin'] or not settings['destination']:
+                st.warning("起点・終点の座標を取得できません。サイドバーの住所・APIキーを確認してください。")
+            else:
+                # フラグをリセット（アニメーション停止）
+                st.session_state['sort_performed'] = False
+                # スケジュール計算
+                origin_lat, origin_lng = settings['origin']
                 
-                # MUSTフラグが立っている箇所のインデックスを取得
-                # locations[0] は起点なので、locations[i+1] が today_list[i] に対応
-                # optimize_route に渡す must_visit_indices は locations のインデックス（1オリジン）
-                must_indices = []
-                for idx, item in enumerate(st.session_state['today_list']):
-                    if item.get('MUST', False):
-                        must_indices.append(idx + 1) # locationsにおけるインデックス
+                # 並び替え済みのリストを使用
+                # インデックスのリスト（0, 1, 2...）を渡す
+                indices = range(len(st.session_state['today_list']))
+                df_today = build_today_df(st.session_state['master_df'], st.session_state['today_list'])
                 
-                # 最適化（2-opt）
-                # route_indicesは locations のインデックス（1オリジン、0は起点）
-                optimized_indices = optimize_route(locations, dist_matrix, must_visit_indices=must_indices)
+                with diagnostics("予定表作成"):
+                    # プレビューと同じ行列（自動並び替えで取得した距離行列、無ければ直線距離）で時刻を割り付ける
+                    matrix, order = preview_matrix(df_today, settings)
+                    schedule = calculate_schedule(
+                        indices, df_today, 
+                        origin_lat, origin_lng, 
+                        settings['departure'],
+                        settings['work_minutes'],
+                        settings['lunch_start'],
+                        settings['lunch_end'],
+                        destination=settings['destination'],
+                        legs=matrix_legs(order, matrix['dist_matrix'], matrix['time_matrix'], matrix['end_index'])
+                    )
+                    
+                    # Excel生成
+                    processed_data = excel_bytes(create_excel(schedule, origin=settings['origin']))
                 
-                # 結果をTODAYリストに反映
-                # optimized_indices は [3, 1, 2, ...] のような順序（locationsのインデックス）
-                # これを today_list のインデックス（0開始）に変換 -> index - 1
-                new_today_list = [st.session_state['today_list'][i-1] for i in optimized_indices]
-                st.session_state['today_list'] = new_today_list
-                st.session_state['sort_performed'] = True # ソート完了フラグ
-                st.success("最短ルート順に並び替えました！")
-                st.rerun()
+                st.download_button(
+                    label="Excelダウンロード",
+                    data=processed_data,
+                    file_name=f"VisitPlan_{datetime.now().strftime('%Y%m%d')}.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                )
+                # ルート全体の地図（経由地の上限を超えると複数のリンクに分かれる）
+                urls = route_map_urls([(settings['origin'], schedule)])[0]
+                for n, url in enumerate(urls, 1):
+                    st.link_button("ルートを地図で開く" + (f" ({n}/{len(urls)})" if len(urls) > 1 else ""), url)
 
-with col_b:
-    if st.session_state.get('sort_performed'):
-        st.markdown('<div class="pulse-btn">', unsafe_allow_html=True)
-        
-    if st.button("訪問予定表 (Excel) 作成"):
-        if not st.session_state['today_list']:
-            st.warning("リストが空です")
-        else:
-            # フラグをリセット（アニメーション停止）
-            st.session_state['sort_performed'] = False
-            # スケジュール計算
-            # ここでも起点は仮
-            origin_lat, origin_lng = 35.534222, 140.111557
-            
-            # 並び替え済みのリストを使用
-            # インデックスのリスト（0, 1, 2...）を渡す
-            indices = range(len(st.session_state['today_list']))
-            df_today = pd.DataFrame(st.session_state['today_list'])
-            
+        if st.session_state.get('sort_performed'):
+            st.markdown('</div>', unsafe_allow_html=True)
+
+
+settings = {
+    'origin': depot['origin'],
+    'destination': depot['destination'],
+    'api_key': api_key,
+    'departure': departure_time_str.strftime("%H:%M"),
+    'work_minutes': work_minutes_def,
+    'lunch_start': lunch_start.strftime("%H:%M"),
+    'lunch_end': lunch_end.strftime("%H:%M"),
+}
+
+# 2ペイン構成
+col1, col2 = st.columns([1, 1])
+
+with col1:
+    master_panel()
+
+with col2:
+    today_panel(settings)
+
+# アクションエリア
+st.markdown("---")
+actions_panel(settings)
+
+
+# 複数ルート／複数日計画
+# 予定表と Excel は「複数ルートを計画」を押した時に1回だけ作り、session_state に置く
+# （fragment なので、この中の操作で他のペインは再実行されない）
+def build_multi_plans(plans, settings):
+    groups = []
+    multi_schedules = []
+    for key, (group_df, routes) in plans.items():
+        schedules = []
+        for route in routes:
+            if not route['indices']:
+                continue
             schedule = calculate_schedule(
-                indices, df_today, 
-                origin_lat, origin_lng, 
-                departure_time_str.strftime("%H:%M"),
-                work_minutes_def,
-                lunch_start.strftime("%H:%M"),
-                lunch_end.strftime("%H:%M")
+                route['indices'], group_df,
+                settings['origin'][0], settings['origin'][1],
+                settings['departure'],
+                settings['work_minutes'],
+                settings['lunch_start'],
+                settings['lunch_end'],
+                destination=settings['destination'],
+                legs=route['legs']
             )
-            
-            # Excel生成
-            wb = openpyxl.Workbook()
-            ws = wb.active
-            ws.title = "VisitPlan"
-            
-            headers = ["対象日付", "順番", "顧客コード", "顧客名", "住所", "作業時間(分)", "到着時刻", "終了時刻", 
-                       "移動時間(分)", "移動距離(km)", "売上見込(円)", "メモ", "GoogleMapURL"]
-            ws.append(headers)
-            
-            today_str = datetime.now().strftime('%Y-%m-%d')
-            
-            # ルートURL生成ロジック（RouteMapURL）は削除
-            
-            # for item in schedule:
-            #     waypoints_list...
-            
+            schedules.append((route, schedule))
+            multi_schedules.append((f"{key}_{route['route_no']}", schedule))
+        groups.append((key, routes, schedules))
+    excel = excel_bytes(create_excel_multi(multi_schedules, origin=settings['origin'])) if multi_schedules else None
+    return {'groups': groups, 'excel': excel}
 
-            for item in schedule:
-                # 距離はメートル -> km
-                dist_km = item['travel_dist']
-                
-                row = [
-                    today_str,
-                    item['seq'],
-                    item['code'],
-                    item['name'],
-                    item['address'],
-                    item['work_min'],
-                    item['arrival_time'].strftime('%H:%M'),
-                    item['finish_time'].strftime('%H:%M'),
-                    item['travel_min'],
-                    dist_km,
-                    item['sales'],
-                    "", # メモ
-                    f"https://www.google.com/maps/search/?api=1&query={item['lat']},{item['lng']}", # GoogleMapURL
-                    # full_route_url # RouteMapURL (削除)
-                ]
-                ws.append(row)
-
-            # バイト列に保存
-            output = io.BytesIO()
-            wb.save(output)
-            processed_data = output.getvalue()
-            
-            st.download_button(
-                label="Excelダウンロード",
-                data=processed_data,
-                file_name=f"VisitPlan_{datetime.now().strftime('%Y%m%d')}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
+@st.fragment
+def multi_route_panel(settings):
+    master_df = st.session_state['master_df']
+    rep_col = CONFIG['master_columns'].get('sales_rep_code', '担当営業員コード')
 
-    if st.session_state.get('sort_performed'):
-        st.markdown('</div>', unsafe_allow_html=True)
+    if master_df.empty:
+        st.info("顧客マスタをアップロードしてください。")
+        return
+
+    source = st.radio("対象顧客", ["担当営業員コードで選択", "TODAYリスト"], horizontal=True)
+    if source == "TODAYリスト" or rep_col not in master_df.columns:
+        target_df = build_today_df(master_df, st.session_state['today_list'])
+        group_col = None
+    else:
+        reps = sorted(master_df[rep_col].dropna().unique().tolist())
+        selected_reps = st.multiselect("担当営業員コード", reps, default=reps[:1])
+        target_df = master_df[master_df[rep_col].isin(selected_reps)]
+        group_col = rep_col
+
+    col_p1, col_p2 = st.columns(2)
+    with col_p1:
+        n_routes = st.number_input("ルート数 / 日数", value=5, min_value=1, max_value=20)
+    with col_p2:
+        method_label = st.radio("分割方法", ["スイープ法", "容量制約付きk-means"], horizontal=True)
+
+    if st.button("複数ルートを計画"):
+        if target_df.empty:
+            st.warning("対象顧客がありません。")
+        elif not settings['origin']:
+            st.warning("起点の座標を取得できません。サイドバーの住所・APIキーを確認してください。")
+        else:
+            with st.spinner("ルート分割・最適化中..."), diagnostics("複数ルート計画"):
+                method = 'kmeans' if method_label == "容量制約付きk-means" else 'sweep'
+                if group_col is None:
+                    target_df = target_df.assign(_group='TODAY')
+                    group_col = '_group'
+                plans = plan_by_group(
+                    target_df, settings['origin'], int(n_routes),
+                    group_col=group_col, method=method, api_key=settings['api_key'], warn=st.warning,
+                    destination=settings['destination']
+                )
+                st.session_state['multi_plans'] = build_multi_plans(plans, settings)
+
+    multi_plans = st.session_state.get('multi_plans')
+    if not multi_plans:
+        return
+    for key, routes, schedules in multi_plans['groups']:
+        st.subheader(f"{rep_col}: {key}")
+        st.dataframe(
+            pd.DataFrame(routes)[['route_no', 'stops', 'distance_km', 'travel_min', 'work_min', 'workload_min', 'gap_pct']],
+            column_config={
+                "route_no": "ルート",
+                "stops": "件数",
+                "distance_km": "移動距離(km)",
+                "travel_min": "移動時間(分)",
+                "work_min": "作業時間(分)",
+                "workload_min": "作業量合計(分)",
+                "gap_pct": st.column_config.NumberColumn("ギャップ(%)", help="下界（Held-Karp）に対する超過率", format="%.1f"),
+            },
+            hide_index=True,
+            use_container_width=True
+        )
+        for route, schedule in schedules:
+            with st.expander(f"ルート {route['route_no']} ({route['stops']}件)"):
+                st.dataframe(
+                    pd.DataFrame(schedule)[['seq', 'code', 'name', 'arrival_time', 'finish_time', 'travel_min', 'sales']],
+                    hide_index=True,
+                    use_container_width=True
+                )
+
+    if multi_plans['excel'] is not None:
+        # 全ルートを1ブック（1ルート1シート）にまとめて出力
+        st.download_button(
+            label="全ルートのExcelダウンロード",
+            data=multi_plans['excel'],
+            file_name=f"VisitPlans_{datetime.now().strftime('%Y%m%d')}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+
+st.markdown("---")
+with st.expander("複数ルート計画 (担当者別・複数日)"):
+    multi_route_panel(settings)
+
+
+# 診断情報（工程ごとの所要時間・API 利用状況）
+with st.sidebar.expander("診断情報"):
+    records = st.session_state.get('diagnostics', [])
+    if not records:
+        st.caption("まだ計測結果はありません。")
+    else:
+        diag_df = pd.DataFrame(records[::-1])
+        spans = diag_df[diag_df['span'] != 'distance_matrix_tile']
+        st.dataframe(
+            spans.drop(columns=['ts'], errors='ignore'),
+            hide_index=True,
+            use_container_width=True
+        )
+        tiles = diag_df[diag_df['span'] == 'distance_matrix_tile']
+        if not tiles.empty:
+            st.caption(f"Distance Matrix: {len(tiles)}リクエスト / {int(tiles['elements'].sum())}要素 / "
+                       f"平均 {tiles['ms'].mean():.0f} ms / エラー要素 {int(tiles['not_ok'].sum())}")
+        if st.button("診断情報をクリア"):
+            st.session_state['diagnostics'] = []
+            st.rerun()
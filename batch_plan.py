@@ -0,0 +1,274 @@
+"""
+訪問予定表の一括作成（コマンドライン）
+
+顧客マスタ1つと、TODAY選択ファイル（顧客コードの一覧）または割当ファイル
+（顧客コード＋計画名の列）を受け取り、計画ごとに
+読み込み → 距離行列 → 並び替え → 時刻割付 → Excel をプロセスプールで並列実行する。
+
+例:
+  python batch_plan.py 桑原マスタ.xlsx --today a.txt b.csv --out-dir out
+  python batch_plan.py 桑原マスタ.xlsx --assignments assign.csv --plan-col 担当営業員コード --combined week.xlsx
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+
+import metrics
+from utils import get_config, load_customer_data, get_distance_matrix, solve_route, calculate_schedule, \
+    create_excel, create_excel_multi, route_locations, matrix_legs, config_path
+from geocoding import default_depot
+
+logger = logging.getLogger("batch_plan")
+
+# TODAY選択ファイル・割当ファイルで顧客コード／MUSTとして認識する列名
+MUST_COLUMNS = ['MUST', 'must']
+
+
+def _code_columns():
+    return ['code', 'CustomerCode', get_config()['master_columns']['customer_code']]
+
+
+# CSV/テキストの読み込み（load_customer_data と同じ順で文字コードを試す）
+def _read_table(path):
+    if path.endswith('.xlsx'):
+        return pd.read_excel(path, dtype=str)
+    for encoding in ['utf-8-sig', 'shift_jis', 'cp932']:
+        try:
+            return pd.read_csv(path, encoding=encoding, dtype=str)
+        except UnicodeDecodeError:
+            continue
+    raise ValueError(f"文字コードを判別できません: {path}")
+
+
+def _find_column(df, candidates):
+    for col in candidates:
+        if col in df.columns:
+            return col
+    return None
+
+
+def _to_bool(value):
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y', '○', 'must')
+
+
+# TODAY選択ファイル：1行1顧客コード（ヘッダー無しのテキスト）または顧客コード列を持つ表
+def read_today_selection(path):
+    if path.endswith('.txt'):
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            codes = [line.strip() for line in f if line.strip()]
+        return pd.DataFrame({'code': codes, 'MUST': False})
+
+    df = _read_table(path)
+    code_col = _find_column(df, _code_columns()) or df.columns[0]
+    must_col = _find_column(df, MUST_COLUMNS)
+    return pd.DataFrame({
+        'code': df[code_col].astype(str).str.strip(),
+        'MUST': df[must_col].map(_to_bool) if must_col else False,
+    })
+
+
+# 割当ファイル：計画名の列の値ごとに1計画
+def read_assignments(path, plan_col):
+    df = _read_table(path)
+    if plan_col not in df.columns:
+        raise ValueError(f"割当ファイルに列 '{plan_col}' がありません: {path}")
+    code_col = _find_column(df, _code_columns()) or df.columns[0]
+    must_col = _find_column(df, MUST_COLUMNS)
+
+    plans = []
+    for plan_name, group in df.groupby(plan_col, sort=True):
+        plans.append((str(plan_name), pd.DataFrame({
+            'code': group[code_col].astype(str).str.strip(),
+            'MUST': group[must_col].map(_to_bool) if must_col else False,
+        })))
+    return plans
+
+
+# 選択された顧客コードをマスタの行に対応付ける（選択ファイルの並び順を維持）
+def select_rows(master_df, selection):
+    master = master_df.assign(_code_key=master_df['code'].astype(str).str.strip())
+    master = master.drop_duplicates('_code_key').set_index('_code_key')
+    found = selection[selection['code'].isin(master.index)]
+    missing = selection.loc[~selection['code'].isin(master.index), 'code'].tolist()
+    rows = master.loc[found['code']].reset_index(drop=True)
+    rows['MUST'] = found['MUST'].to_numpy()
+    return rows, missing
+
+
+# 1計画分の処理（プロセスプールのワーカーで実行される）
+def run_plan(job):
+    name = job['name']
+    df_today = job['df_today']
+    settings = job['settings']
+    timings = {}
+
+    try:
+        origin_lat, origin_lng = settings['origin']
+        destination = settings['destination'] or settings['origin']
+
+        t0 = time.perf_counter()
+        locations, end_index = route_locations(settings['origin'], df_today['lat'], df_today['lng'], destination)
+        dist_matrix, time_matrix = get_distance_matrix(locations, api_key=settings['api_key'])
+        timings['matrix'] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        must_indices = [i + 1 for i, must in enumerate(df_today['MUST']) if must]
+        solved = solve_route(locations, dist_matrix, must_visit_indices=must_indices, end_index=end_index)
+        optimized = solved['route']
+        timings['optimize'] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        schedule = calculate_schedule(
+            [i - 1 for i in optimized], df_today,
+            origin_lat, origin_lng,
+            settings['departure'],
+            settings['work_minutes'],
+            settings['lunch_start'],
+            settings['lunch_end'],
+            destination=destination,
+            legs=matrix_legs(optimized, dist_matrix, time_matrix, end_index)
+        )
+        timings['schedule'] = time.perf_counter() - t0
+
+        path = None
+        if settings['out_dir']:
+            t0 = time.perf_counter()
+            path = os.path.join(settings['out_dir'], f"VisitPlan_{_safe_name(name)}_{datetime.now().strftime('%Y%m%d')}.xlsx")
+            create_excel(schedule, origin=settings['origin']).save(path)
+            timings['excel'] = time.perf_counter() - t0
+
+        return {'name': name, 'schedule': schedule, 'path': path, 'timings': timings, 'gap_pct': solved['gap_pct'],
+                'error': None}
+
+    except Exception as e:
+        return {'name': name, 'schedule': None, 'path': None, 'timings': timings, 'error': str(e)}
+
+
+def _safe_name(name):
+    return "".join(ch if ch.isalnum() or ch in '-_' else '_' for ch in str(name))
+
+
+def _parse_latlng(value):
+    lat, lng = value.split(',')
+    return float(lat), float(lng)
+
+
+def build_parser():
+    config = get_config()
+    defaults = config['defaults']
+    parser = argparse.ArgumentParser(description="訪問予定表(Excel)を一括作成します")
+    parser.add_argument("master", help="顧客マスタ (.xlsx / .csv)")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--today", nargs='+', metavar="FILE",
+                        help="TODAY選択ファイル（.txt: 1行1顧客コード / .csv/.xlsx: 顧客コード列, 任意でMUST列）。1ファイル = 1計画")
+    source.add_argument("--assignments", nargs='+', metavar="FILE",
+                        help="割当ファイル（顧客コード列と --plan-col の列）。列の値ごとに1計画")
+    parser.add_argument("--plan-col", default="plan", help="割当ファイルの計画名の列 (既定: plan)")
+    parser.add_argument("--origin", type=_parse_latlng, default=None,
+                        help="起点の緯度経度 'lat,lng'（既定: config.yaml の defaults.origin_address）")
+    parser.add_argument("--destination", type=_parse_latlng, default=None,
+                        help="終点の緯度経度 'lat,lng'（既定: --origin 指定時は起点に戻る。"
+                             "未指定時は defaults.destination_address）")
+    parser.add_argument("--departure", default=defaults['departure_time'], help="出発時刻 HH:MM")
+    parser.add_argument("--work-minutes", type=int, default=defaults['work_minutes'], help="標準作業時間(分)")
+    parser.add_argument("--lunch-start", default=defaults['lunch_start'])
+    parser.add_argument("--lunch-end", default=defaults['lunch_end'])
+    parser.add_argument("--api-key", default=os.environ.get("GOOGLE_MAPS_API_KEY") or config.get('google_maps_api_key') or None,
+                        help="Google Maps APIキー（既定: 環境変数 GOOGLE_MAPS_API_KEY）。未指定時は直線距離")
+    parser.add_argument("--out-dir", default=None, help="計画ごとのExcelの出力先フォルダ")
+    parser.add_argument("--combined", default=None, help="全計画を1ブック（1計画1シート）にまとめて出力するファイル")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="並列プロセス数（1で逐次実行）")
+    parser.add_argument("--config", default=None, help="設定ファイル（既定: config.yaml）")
+    return parser
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    # --config は他の引数の既定値に影響するので先に読む
+    pre = argparse.ArgumentParser(add_help=False)
+    pre.add_argument("--config", default=None)
+    get_config(pre.parse_known_args(argv)[0].config)
+    args = build_parser().parse_args(argv)
+    metrics.configure_from_config()
+
+    if args.origin is None:
+        origin, destination, error = default_depot(api_key=args.api_key)
+        if error:
+            logger.error(f"起点を解決できません（--origin で指定してください）: {error}")
+            return 1
+        args.origin = origin
+        args.destination = args.destination or destination
+
+    if not args.out_dir and not args.combined:
+        args.out_dir = "."
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+
+    with open(args.master, 'rb') as f:
+        master_df, error = load_customer_data(f)
+    if error:
+        logger.error(f"顧客マスタを読み込めません: {error}")
+        return 1
+    logger.info(f"{len(master_df)}件の顧客データを読み込みました。")
+
+    if args.today:
+        selections = [(os.path.splitext(os.path.basename(p))[0], read_today_selection(p)) for p in args.today]
+    else:
+        selections = []
+        for path in args.assignments:
+            selections.extend(read_assignments(path, args.plan_col))
+
+    settings = {
+        'origin': args.origin,
+        'destination': args.destination,
+        'departure': args.departure,
+        'work_minutes': args.work_minutes,
+        'lunch_start': args.lunch_start,
+        'lunch_end': args.lunch_end,
+        'api_key': args.api_key,
+        'out_dir': args.out_dir,
+    }
+
+    jobs = []
+    for name, selection in selections:
+        df_today, missing = select_rows(master_df, selection)
+        if missing:
+            logger.warning(f"[{name}] マスタに無い顧客コード {len(missing)}件を除外しました: {', '.join(missing[:10])}")
+        if df_today.empty:
+            logger.warning(f"[{name}] 対象顧客が無いためスキップします。")
+            continue
+        jobs.append({'name': name, 'df_today': df_today, 'settings': settings})
+
+    if args.workers and args.workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(args.workers, len(jobs)),
+                                 initializer=get_config, initargs=(config_path(),)) as executor:
+            results = list(executor.map(run_plan, jobs))
+    else:
+        results = [run_plan(job) for job in jobs]
+
+    failed = 0
+    for result in results:
+        if result['error']:
+            failed += 1
+            logger.error(f"[{result['name']}] 失敗: {result['error']}")
+        else:
+            spent = ", ".join(f"{k}={v:.2f}s" for k, v in result['timings'].items())
+            logger.info(f"[{result['name']}] {len(result['schedule'])}件 {result['path'] or ''} "
+                        f"(ギャップ {result['gap_pct']:.1f}%, {spent})")
+
+    if args.combined:
+        plans = [(r['name'], r['schedule']) for r in results if not r['error']]
+        create_excel_multi(plans, origin=args.origin).save(args.combined)
+        logger.info(f"{len(plans)}件の計画を {args.combined} に出力しました。")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
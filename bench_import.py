@@ -0,0 +1,90 @@
+"""
+import 時間の計測（起動の遅延・不要な重い import の混入を検出する）
+
+各モジュールを新しい Python プロセスで import し、
+  - pandas / numpy を import した後に、そのモジュールの import にかかる時間（モジュール自身のコスト）
+  - 重い依存（streamlit, googlemaps, openpyxl, yaml）が import 時に読み込まれていないこと
+を確認する。重い依存を import 時に読み込んだ、または import 時間が許容時間を超えた場合は終了コード 1
+（--warn-only なら許容時間の超過は警告のみ）。
+同じプロセスで pandas / numpy を先に読み込んでから計るので、プロセスごとの揺れが差に入らない。
+計測の揺れで誤って失敗しないよう、各計測は最小値を使う。
+
+  python bench_import.py
+  python bench_import.py --runs 7 --max-overhead-ms 60 --json
+"""
+import argparse
+import json
+import subprocess
+import sys
+import os
+
+MODULES = ['utils', 'planner', 'distance_stub', 'batch_plan', 'plan_service', 'route_jobs', 'geocoding', 'master_store', 'route_links']
+BASELINE = 'pandas, numpy'
+LAZY_MODULES = ['streamlit', 'googlemaps', 'openpyxl', 'yaml']
+
+_PROBE = """
+import sys, time, json
+t0 = time.perf_counter()
+import {baseline}
+t1 = time.perf_counter()
+import {module}
+t2 = time.perf_counter()
+print(json.dumps({{'ms': (t2 - t0) * 1000, 'overhead_ms': (t2 - t1) * 1000,
+                  'loaded': [m for m in {lazy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(module, runs):
+    here = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    overheads = []
+    loaded = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, '-c', _PROBE.format(baseline=BASELINE, module=module, lazy=LAZY_MODULES)],
+            cwd=here, capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        samples.append(result['ms'])
+        overheads.append(result['overhead_ms'])
+        loaded = result['loaded']
+    # 計測の揺れ（他プロセス・ディスクキャッシュ）は時間を増やす方向にしか働かないので最小値を採用する
+    return min(samples), min(overheads), loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="import 時間の計測")
+    parser.add_argument("--runs", type=int, default=7, help="モジュールごとの計測回数（最小値を採用）")
+    parser.add_argument("--max-overhead-ms", type=float, default=60.0,
+                        help="pandas/numpy の import を除いた許容時間(ms)。超えたら終了コード 1")
+    parser.add_argument("--warn-only", action="store_true",
+                        help="許容時間の超過は警告のみにする（重い依存の import は常に失敗）")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力")
+    args = parser.parse_args(argv)
+
+    baseline_ms, _, _ = measure('sys', args.runs)
+    limit_ms = args.max_overhead_ms
+    results = []
+    failed = False
+    for module in MODULES:
+        ms, overhead, loaded = measure(module, args.runs)
+        slow = overhead > limit_ms
+        failed |= bool(loaded) or (slow and not args.warn_only)
+        results.append({'module': module, 'import_ms': round(ms, 1), 'overhead_ms': round(overhead, 1),
+                        'eager_heavy_imports': loaded, 'slow': slow, 'ok': not loaded and not slow})
+
+    if args.json:
+        print(json.dumps({'baseline_ms': round(baseline_ms, 1), 'limit_ms': round(limit_ms, 1), 'results': results}, ensure_ascii=False, indent=2))
+    else:
+        print(f"baseline ({BASELINE}): {baseline_ms:.1f} ms  許容: +{limit_ms:.0f} ms")
+        for r in results:
+            mark = "NG " if r['eager_heavy_imports'] or (r['slow'] and not args.warn_only) else \
+                ("WARN" if r['slow'] else "OK ")
+            extra = f"  重い依存を import 時に読み込み: {', '.join(r['eager_heavy_imports'])}" if r['eager_heavy_imports'] else ""
+            print(f"{mark} {r['module']:<14} {r['import_ms']:8.1f} ms (+{r['overhead_ms']:.1f} ms){extra}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,311 @@
+"""
+性能ベンチマーク（合成マスタによる end-to-end 計測）
+
+千葉周辺にランダムな顧客を配置した合成マスタ（1k/10k/100k行、cp932 CSV と xlsx）を生成し、
+  - load_customer_data
+  - get_distance_matrix（直線距離フォールバック／スタブAPI／HTTP の代替サーバ）
+  - optimize_route（30/100/500件。ルート距離も記録）
+  - 下界による 2-opt の打ち切り（10/30/60件×20日。打ち切り無しと config のしきい値で周回数を比べる）
+  - calculate_schedule
+  - create_excel
+の所要時間を計測する。受け入れ基準（要件定義書 6, 12）も判定する:
+  - 1,000件から30件を選んで自動並び替えまで 15秒以内
+  - フォールバック（直線距離）で 3秒以内
+
+結果は JSON で出力でき、保存済みのベースラインと比較できる。
+
+  python benchmark.py --sizes 1000 10000 --output bench.json
+  python benchmark.py --baseline bench_baseline.json --tolerance 0.25
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from utils import load_customer_data, get_distance_matrix, optimize_route, solve_route, calculate_schedule, \
+    create_excel, excel_bytes, create_maps_client, get_config
+from distance_stub import StubDistanceClient, start_stand_in
+
+CHIBA_CENTER = (35.55, 140.15)
+DEPOT = (35.534222, 140.111557)
+
+ACCEPTANCE_API_SEC = 15.0
+ACCEPTANCE_FALLBACK_SEC = 3.0
+
+
+# 合成マスタの生成（実マスタと同じ列構成・1行目は注記、2行目がヘッダー）
+def make_master(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    lat = CHIBA_CENTER[0] + rng.normal(0, 0.12, n_rows)
+    lng = CHIBA_CENTER[1] + rng.normal(0, 0.15, n_rows)
+    cities = np.array(['市原市', '千葉市中央区', '袖ケ浦市', '木更津市', '市川市', '船橋市'])
+    no_entry = np.where(rng.random(n_rows) < 0.05, '12:00-13:00', '')
+
+    return pd.DataFrame({
+        '年月': 202601,
+        '顧客コード': [f"{100000000 + i} " for i in range(n_rows)],
+        '顧客名称': [f"テスト自販機{i}" for i in range(n_rows)],
+        'オープン・クローズ': rng.integers(1, 3, n_rows),
+        '純売上金額': rng.integers(1000, 60000, n_rows),
+        '担当営業員コード': rng.choice([14384, 14385, 14390, 14402, 14411], n_rows),
+        '最終取引日': 20260201,
+        '郵便番号': 2900051,
+        '都道府県': '千葉県',
+        '市・区': rng.choice(cities, n_rows),
+        '住所1': [f"五井{i % 50 + 1}－{i % 7 + 1}" for i in range(n_rows)],
+        '緯度経度': [f"{a:.6f}, {b:.6f}" for a, b in zip(lat, lng)],
+        '作業時間': rng.integers(10, 21, n_rows),
+        '入場不可時間帯': no_entry,
+        '月間稼働日数': 30,
+        '1日あたり': rng.integers(100, 2000, n_rows),
+        '最終取引日からの経過日数': rng.integers(1, 30, n_rows),
+        '売上見込': rng.integers(1, 40, n_rows) * 1000,
+    })
+
+
+def write_master(df, path):
+    note = ['ベンチマーク用合成マスタ'] + [''] * (len(df.columns) - 1)
+    if path.endswith('.csv'):
+        with open(path, 'w', encoding='cp932', newline='') as f:
+            f.write(",".join(note) + "\n")
+            df.to_csv(f, index=False)
+    else:
+        import openpyxl
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet()
+        ws.append(note)
+        ws.append(list(df.columns))
+        for row in df.itertuples(index=False):
+            ws.append([v.item() if isinstance(v, np.generic) else v for v in row])
+        wb.save(path)
+
+
+def ensure_master(data_dir, n_rows, fmt):
+    path = os.path.join(data_dir, f"synthetic_master_{n_rows}.{fmt}")
+    if not os.path.exists(path):
+        write_master(make_master(n_rows), path)
+    return path
+
+
+def random_locations(n_stops, seed=1):
+    rng = np.random.default_rng(seed)
+    return [{'lat': DEPOT[0], 'lng': DEPOT[1]}] + [
+        {'lat': CHIBA_CENTER[0] + a, 'lng': CHIBA_CENTER[1] + b}
+        for a, b in zip(rng.normal(0, 0.12, n_stops), rng.normal(0, 0.15, n_stops))
+    ]
+
+
+def route_cost(route, dist_matrix):
+    path = [0] + list(route)
+    return float(sum(dist_matrix[a][b] for a, b in zip(path, path[1:])))
+
+
+class Bench:
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+
+    def run(self, name, func, **params):
+        """func() を repeat 回実行し中央値を記録。func の戻り値が dict なら指標として記録する"""
+        runs = []
+        metrics = {}
+        func()  # 初回（遅延 import 等）は計測しない
+        for _ in range(self.repeat):
+            t0 = time.perf_counter()
+            out = func()
+            runs.append(time.perf_counter() - t0)
+            if isinstance(out, dict):
+                metrics = out
+        result = {'name': name, 'params': params, 'seconds': statistics.median(runs),
+                  'runs': runs, 'metrics': metrics}
+        self.results.append(result)
+        extra = " ".join(f"{k}={v}" for k, v in metrics.items())
+        print(f"{name:<28} {json.dumps(params, ensure_ascii=False):<36} {result['seconds']:9.4f} s  {extra}",
+              file=sys.stderr)
+        return result
+
+
+def _load(path):
+    with open(path, 'rb') as f:
+        df, error = load_customer_data(f)
+    if error:
+        raise RuntimeError(error)
+    return df
+
+
+def run_benchmarks(args):
+    bench = Bench(args.repeat)
+    data_dir = args.data_dir or os.path.join(tempfile.gettempdir(), "visitplan_bench")
+    os.makedirs(data_dir, exist_ok=True)
+
+    # 読み込み
+    for n_rows in args.sizes:
+        for fmt in args.formats:
+            path = ensure_master(data_dir, n_rows, fmt)
+            bench.run('load_customer_data', lambda: {'rows': len(_load(path))}, rows=n_rows, format=fmt)
+
+    # 距離行列（起点 + 30件）
+    locations = random_locations(30)
+    bench.run('get_distance_matrix', lambda: get_distance_matrix(locations) and None, stops=30, provider='fallback')
+
+    def stub_matrix():
+        client = StubDistanceClient()
+        get_distance_matrix(locations, client=client)
+        return {'api_calls': client.calls, 'elements': client.elements}
+    bench.run('get_distance_matrix', stub_matrix, stops=30, provider='stub')
+
+    # HTTP の代替サーバ経由（googlemaps.Client のタイル分割・再試行を含む）
+    server, base_url = start_stand_in(latency_ms=args.stand_in_latency_ms,
+                                      over_query_limit_rate=args.stand_in_oql_rate, seed=0)
+    try:
+        def stand_in_matrix():
+            before = dict(server.stand_in.stats)
+            get_distance_matrix(locations, client=create_maps_client(base_url=base_url))
+            return {k: server.stand_in.stats[k] - before[k] for k in ('requests', 'over_query_limit')}
+        bench.run('get_distance_matrix', stand_in_matrix, stops=30, provider='stand_in',
+                  latency_ms=args.stand_in_latency_ms, oql_rate=args.stand_in_oql_rate)
+    finally:
+        server.shutdown()
+
+    # 並び替え（ルート距離も記録）
+    for n_stops in args.stops:
+        locs = random_locations(n_stops)
+        dist_matrix, _ = get_distance_matrix(locs)
+
+        def optimize():
+            route = optimize_route(locs, dist_matrix)
+            return {'route_cost_m': round(route_cost(route, dist_matrix), 1)}
+        bench.run('optimize_route', optimize, stops=n_stops)
+
+    # 下界による打ち切り：同じ日々を打ち切り無し（0）と config の optimizer.gap_threshold_pct で解く
+    threshold = (get_config().get('optimizer') or {}).get('gap_threshold_pct', 0)
+    for n_stops in args.early_stop_stops:
+        days = []
+        for seed in range(args.early_stop_days):
+            locs = random_locations(n_stops, seed=seed)
+            days.append((locs, get_distance_matrix(locs)[0]))
+
+        def early_stop(gap_threshold_pct):
+            with metrics.collect() as records:
+                results = [solve_route(locs, dist_matrix, gap_threshold_pct=gap_threshold_pct)
+                           for locs, dist_matrix in days]
+            return {
+                'passes': sum(r['iterations'] for r in records if r['span'] == 'optimize_route'),
+                'stopped_early': sum(r['stopped_early'] for r in results),
+                'route_cost_m': round(sum(r['cost'] for r in results), 1),
+            }
+        for gap_threshold_pct in sorted({0, threshold}):
+            bench.run('solve_route_early_stop', lambda: early_stop(gap_threshold_pct),
+                      stops=n_stops, days=args.early_stop_days, gap_threshold_pct=gap_threshold_pct)
+
+    # 時刻割付・Excel（1,000件のマスタから30件）
+    master = _load(ensure_master(data_dir, 1000, 'csv'))
+    df_today = master.sample(30, random_state=0).reset_index(drop=True)
+    schedule = calculate_schedule(range(30), df_today, DEPOT[0], DEPOT[1], "09:00", 15, "12:00", "13:00")
+    bench.run('calculate_schedule', lambda: calculate_schedule(range(30), df_today, DEPOT[0], DEPOT[1],
+                                                               "09:00", 15, "12:00", "13:00") and None, stops=30)
+    bench.run('create_excel', lambda: {'bytes': len(excel_bytes(create_excel(schedule, origin=DEPOT)))}, stops=30)
+
+    # 受け入れ基準：1,000件から30件を選んで並び替え完了まで
+    def end_to_end(client):
+        df = _load(ensure_master(data_dir, 1000, 'csv'))
+        today = df.sample(30, random_state=0)
+        locs = [{'lat': DEPOT[0], 'lng': DEPOT[1]}] + \
+               [{'lat': lat, 'lng': lng} for lat, lng in zip(today['lat'], today['lng'])]
+        dist_matrix, _ = get_distance_matrix(locs, client=client)
+        route = optimize_route(locs, dist_matrix)
+        return {'route_cost_m': round(route_cost(route, dist_matrix), 1)}
+
+    api = bench.run('end_to_end_1000_to_30', lambda: end_to_end(StubDistanceClient()), provider='stub')
+    fallback = bench.run('end_to_end_1000_to_30', lambda: end_to_end(None), provider='fallback')
+    acceptance = {
+        'api_under_15s': api['seconds'] < ACCEPTANCE_API_SEC,
+        'fallback_under_3s': fallback['seconds'] < ACCEPTANCE_FALLBACK_SEC,
+    }
+
+    return {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+        },
+        'results': bench.results,
+        'acceptance': acceptance,
+    }
+
+
+def _key(result):
+    return result['name'] + json.dumps(result['params'], sort_keys=True, ensure_ascii=False)
+
+
+# ベースラインとの比較：時間が tolerance 以上（かつ min_delta 秒以上）遅い、
+# またはルート距離が悪化したものを返す
+def compare(current, baseline, tolerance, min_delta=0.005):
+    base = {_key(r): r for r in baseline['results']}
+    regressions = []
+    for r in current['results']:
+        b = base.get(_key(r))
+        if b is None:
+            continue
+        if r['seconds'] > b['seconds'] * (1 + tolerance) and r['seconds'] - b['seconds'] > min_delta:
+            regressions.append(f"{r['name']} {r['params']}: {b['seconds']:.4f}s -> {r['seconds']:.4f}s")
+        cost, base_cost = r['metrics'].get('route_cost_m'), b['metrics'].get('route_cost_m')
+        if cost is not None and base_cost is not None and cost > base_cost * 1.001:
+            regressions.append(f"{r['name']} {r['params']}: route cost {base_cost} -> {cost}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="性能ベンチマーク")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[1000, 10000, 100000], help="合成マスタの行数")
+    parser.add_argument("--formats", nargs='+', default=['csv', 'xlsx'], choices=['csv', 'xlsx'])
+    parser.add_argument("--stops", type=int, nargs='+', default=[30, 100, 500], help="optimize_route の件数")
+    parser.add_argument("--early-stop-stops", type=int, nargs='+', default=[10, 30, 60],
+                        help="下界による打ち切りを比べる件数")
+    parser.add_argument("--early-stop-days", type=int, default=20, help="打ち切りを比べる日数（件数ごと）")
+    parser.add_argument("--stand-in-latency-ms", type=float, default=20, help="代替サーバの応答遅延(ms)")
+    parser.add_argument("--stand-in-oql-rate", type=float, default=0.0, help="代替サーバが OVER_QUERY_LIMIT を返す確率")
+    parser.add_argument("--repeat", type=int, default=3, help="各計測の繰り返し回数（中央値を採用）")
+    parser.add_argument("--data-dir", default=None, help="合成マスタの保存先（既定: 一時フォルダ。生成済みなら再利用）")
+    parser.add_argument("--output", default=None, help="結果 JSON の出力先（既定: 標準出力）")
+    parser.add_argument("--baseline", default=None, help="比較するベースライン JSON")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="許容する時間の悪化率")
+    parser.add_argument("--min-delta", type=float, default=0.005, help="これ未満の時間差（秒）は悪化とみなさない")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args)
+
+    failed = not all(report['acceptance'].values())
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.tolerance, args.min_delta)
+        report['regressions'] = regressions
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        failed |= bool(regressions)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    for name, ok in report['acceptance'].items():
+        print(f"{'OK' if ok else 'NG'} {name}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
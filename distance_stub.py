@@ -0,0 +1,329 @@
+import json
+import logging
+import sys
+import time
+
+from utils import haversine
+
+# Google Maps Distance Matrix の代替プロバイダ（ローカル検証用）
+# googlemaps.Client.distance_matrix と同じ引数・同じ JSON 形式の応答を返す。
+# 距離は直線距離に迂回係数を掛けた「道路らしい」値、時間は平均速度から算出する。
+
+logger = logging.getLogger("distance_stub")
+
+DETOUR_FACTOR = 1.3    # 直線距離 → 道路距離の係数
+SPEED_KMH = 30         # 平均速度
+
+
+def road_like_element(origin, destination, detour=DETOUR_FACTOR, speed_kmh=SPEED_KMH):
+    """origin, destination: (lat, lng)"""
+    d_km = haversine(origin[1], origin[0], destination[1], destination[0]) * detour
+    meters = int(round(d_km * 1000))
+    seconds = int(round(d_km / speed_kmh * 3600))
+    return {
+        'status': 'OK',
+        'distance': {'text': f"{d_km:.1f} km", 'value': meters},
+        'duration': {'text': f"{seconds // 60} mins", 'value': seconds},
+        'duration_in_traffic': {'text': f"{seconds // 60} mins", 'value': seconds},
+    }
+
+
+def _as_latlng(value):
+    if isinstance(value, dict):
+        return float(value['lat']), float(value['lng'])
+    if isinstance(value, str):
+        lat, lng = value.split(',')
+        return float(lat), float(lng)
+    return float(value[0]), float(value[1])
+
+
+class StubDistanceClient:
+    """
+    get_distance_matrix(locations, client=StubDistanceClient()) のように渡して使う。
+    calls / elements で呼び出し回数と要素数を確認できる。
+    """
+
+    def __init__(self, detour=DETOUR_FACTOR, speed_kmh=SPEED_KMH):
+        self.detour = detour
+        self.speed_kmh = speed_kmh
+        self.calls = 0
+        self.elements = 0
+
+    def distance_matrix(self, origins, destinations, mode='driving', departure_time=None, **kwargs):
+        origins = [_as_latlng(o) for o in origins]
+        destinations = [_as_latlng(d) for d in destinations]
+        self.calls += 1
+        self.elements += len(origins) * len(destinations)
+        return {
+            'status': 'OK',
+            'origin_addresses': [f"{lat},{lng}" for lat, lng in origins],
+            'destination_addresses': [f"{lat},{lng}" for lat, lng in destinations],
+            'rows': [
+                {'elements': [road_like_element(o, d, self.detour, self.speed_kmh) for d in destinations]}
+                for o in origins
+            ],
+        }
+
+
+class StubGeocoder:
+    """
+    googlemaps.Client.geocode の代替（オフライン用）。
+    table（住所 → (lat, lng)）にある住所だけを解決し、それ以外は空の結果（ZERO_RESULTS）を返す。
+    table を省略すると config.yaml の geocoding.known_addresses を使う。
+    """
+
+    def __init__(self, table=None):
+        from geocoding import normalize_address, known_addresses
+        self._normalize = normalize_address
+        self.table = {normalize_address(k): v for k, v in table.items()} if table is not None else known_addresses()
+        self.calls = 0
+
+    def geocode(self, address, **kwargs):
+        self.calls += 1
+        latlng = self.table.get(self._normalize(address))
+        if latlng is None:
+            return []
+        return [{
+            'formatted_address': address,
+            'geometry': {'location': {'lat': float(latlng[0]), 'lng': float(latlng[1])}, 'location_type': 'ROOFTOP'},
+        }]
+
+
+# ---------------------------------------------------------------------------
+# HTTP の代替サーバ（Distance Matrix API と同じ URL・JSON 形式）
+#
+# config.yaml の google_maps.base_url をこのサーバに向けると、googlemaps.Client を含む
+# 本番と同じ経路（タイル分割・再試行・フォールバック）を API キー無しで負荷試験できる。
+#   - 応答の遅延（latency_ms ± jitter_ms）
+#   - OVER_QUERY_LIMIT（確率 / 1秒あたりの上限）・要素数の上限（OVER_DAILY_LIMIT）
+#   - 要素単位のエラー（ZERO_RESULTS / NOT_FOUND）
+#   - 実 API 応答の記録（--record）と再生（--replay）
+#   - Geocoding API（/maps/api/geocode/json）は StubGeocoder の表で応答する
+#
+#   python distance_stub.py --port 8766 --latency-ms 80 --over-query-limit-rate 0.05
+#   python distance_stub.py --record recorded.json   # 実 API に中継して保存（キーは保存しない）
+#   python distance_stub.py --replay recorded.json
+# ---------------------------------------------------------------------------
+
+DISTANCE_MATRIX_PATH = '/maps/api/distancematrix/json'
+GEOCODE_PATH = '/maps/api/geocode/json'
+GOOGLE_BASE_URL = 'https://maps.googleapis.com'
+MAX_ELEMENTS = 100          # 1リクエストあたりの要素数の上限（API と同じ）
+MAX_DIMENSIONS = 25         # origins / destinations それぞれの上限
+ELEMENT_ERRORS = ['ZERO_RESULTS', 'NOT_FOUND']
+
+
+def _record_key(params):
+    """記録・再生のキー（API キー・出発時刻は含めない）"""
+    return "|".join([params.get('origins', ''), params.get('destinations', ''), params.get('mode', 'driving')])
+
+
+class DistanceMatrixStandIn:
+    """
+    代替サーバの挙動（遅延・エラー注入・記録/再生）と集計。
+    make_stand_in_server(DistanceMatrixStandIn(...)) で HTTP サーバにする。
+    """
+
+    def __init__(self, latency_ms=0, jitter_ms=0, over_query_limit_rate=0.0, max_qps=None,
+                 element_quota=None, element_error_rate=0.0, record=None, replay=None, seed=None,
+                 detour=DETOUR_FACTOR, speed_kmh=SPEED_KMH):
+        import random
+        import threading
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.over_query_limit_rate = over_query_limit_rate
+        self.max_qps = max_qps
+        self.element_quota = element_quota
+        self.element_error_rate = element_error_rate
+        self.record_path = record
+        self.detour = detour
+        self.speed_kmh = speed_kmh
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._recent = []   # 直近1秒のリクエスト時刻（max_qps 用）
+        self.responses = {}
+        if replay:
+            with open(replay, 'r', encoding='utf-8') as f:
+                self.responses = json.load(f)
+        self.replay = bool(replay)
+        self.stats = {'requests': 0, 'elements': 0, 'over_query_limit': 0, 'over_daily_limit': 0,
+                      'element_errors': 0, 'replay_hits': 0, 'replay_misses': 0, 'recorded': 0}
+
+    def _sleep(self):
+        delay = self.latency_ms + (self._random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+    # 割り当て超過の判定（該当すればエラー応答の status を返す）
+    def _quota_status(self, n_elements):
+        now = time.monotonic()
+        with self._lock:
+            self.stats['requests'] += 1
+            self._recent = [t for t in self._recent if now - t < 1.0] + [now]
+            if self.max_qps and len(self._recent) > self.max_qps:
+                self.stats['over_query_limit'] += 1
+                return 'OVER_QUERY_LIMIT'
+            if self._random.random() < self.over_query_limit_rate:
+                self.stats['over_query_limit'] += 1
+                return 'OVER_QUERY_LIMIT'
+            if self.element_quota is not None and self.stats['elements'] + n_elements > self.element_quota:
+                self.stats['over_daily_limit'] += 1
+                return 'OVER_DAILY_LIMIT'
+            self.stats['elements'] += n_elements
+        return None
+
+    def _generate(self, origins, destinations):
+        rows = []
+        for o in origins:
+            elements = []
+            for d in destinations:
+                with self._lock:
+                    failed = self._random.random() < self.element_error_rate
+                    status = self._random.choice(ELEMENT_ERRORS) if failed else 'OK'
+                    if failed:
+                        self.stats['element_errors'] += 1
+                elements.append({'status': status} if failed else road_like_element(o, d, self.detour, self.speed_kmh))
+            rows.append({'elements': elements})
+        return {
+            'status': 'OK',
+            'origin_addresses': [f"{lat},{lng}" for lat, lng in origins],
+            'destination_addresses': [f"{lat},{lng}" for lat, lng in destinations],
+            'rows': rows,
+        }
+
+    # 実 API に中継して応答を保存する
+    def _proxy(self, query, key):
+        from urllib.request import urlopen
+        with urlopen(f"{GOOGLE_BASE_URL}{DISTANCE_MATRIX_PATH}?{query}", timeout=30) as res:
+            body = json.loads(res.read().decode('utf-8'))
+        if body.get('status') == 'OK':
+            with self._lock:
+                self.responses[key] = body
+                self.stats['recorded'] += 1
+                with open(self.record_path, 'w', encoding='utf-8') as f:
+                    json.dump(self.responses, f, ensure_ascii=False)
+        return body
+
+    def handle(self, query):
+        """query: クエリ文字列。戻り値: Distance Matrix の応答 dict"""
+        from urllib.parse import parse_qs
+        params = {k: v[0] for k, v in parse_qs(query).items()}
+        if not params.get('key') and not params.get('client'):
+            return {'status': 'REQUEST_DENIED', 'error_message': 'The provided API key is invalid.'}
+        try:
+            origins = [_as_latlng(v) for v in params['origins'].split('|')]
+            destinations = [_as_latlng(v) for v in params['destinations'].split('|')]
+        except (KeyError, ValueError):
+            return {'status': 'INVALID_REQUEST', 'error_message': 'origins / destinations を解釈できません'}
+
+        self._sleep()
+        if self.record_path:
+            return self._proxy(query, _record_key(params))
+
+        if len(origins) > MAX_DIMENSIONS or len(destinations) > MAX_DIMENSIONS:
+            return {'status': 'MAX_DIMENSIONS_EXCEEDED'}
+        if len(origins) * len(destinations) > MAX_ELEMENTS:
+            return {'status': 'MAX_ELEMENTS_EXCEEDED'}
+        status = self._quota_status(len(origins) * len(destinations))
+        if status:
+            return {'status': status, 'error_message': 'simulated by distance_stub'}
+
+        if self.replay:
+            recorded = self.responses.get(_record_key(params))
+            with self._lock:
+                self.stats['replay_hits' if recorded else 'replay_misses'] += 1
+            if recorded:
+                return recorded
+        return self._generate(origins, destinations)
+
+
+def _stand_in_handler():
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            path, _, query = self.path.partition('?')
+            if path == DISTANCE_MATRIX_PATH:
+                self._send_json(200, self.server.stand_in.handle(query))
+            elif path == GEOCODE_PATH:
+                from urllib.parse import parse_qs
+                address = parse_qs(query).get('address', [''])[0]
+                results = self.server.geocoder.geocode(address)
+                self._send_json(200, {'status': 'OK' if results else 'ZERO_RESULTS', 'results': results})
+            elif path == '/stats':
+                self._send_json(200, self.server.stand_in.stats)
+            else:
+                self._send_json(404, {'error': 'not found'})
+
+        def log_message(self, format, *args):
+            # クエリ（座標・キー）はログに残さない
+            logger.debug("%s %s", self.address_string(), self.command)
+
+    return Handler
+
+
+def make_stand_in_server(stand_in, host='127.0.0.1', port=8766):
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer((host, port), _stand_in_handler())
+    server.daemon_threads = True
+    server.stand_in = stand_in
+    server.geocoder = StubGeocoder()
+    return server
+
+
+def start_stand_in(host='127.0.0.1', port=0, **options):
+    """バックグラウンドのスレッドで起動する（ベンチマーク用）。戻り値: (server, base_url)"""
+    import threading
+    server = make_stand_in_server(DistanceMatrixStandIn(**options), host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{server.server_address[0]}:{server.server_address[1]}"
+
+
+def main(argv=None):
+    import argparse
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description="Distance Matrix API のローカル代替サーバ")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--latency-ms", type=float, default=0, help="応答の遅延(ms)")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="遅延のばらつき(±ms)")
+    parser.add_argument("--over-query-limit-rate", type=float, default=0.0, help="OVER_QUERY_LIMIT を返す確率")
+    parser.add_argument("--max-qps", type=int, default=None, help="1秒あたりのリクエスト上限（超過分は OVER_QUERY_LIMIT）")
+    parser.add_argument("--element-quota", type=int, default=None, help="要素数の上限（超過後は OVER_DAILY_LIMIT）")
+    parser.add_argument("--element-error-rate", type=float, default=0.0, help="要素単位で ZERO_RESULTS/NOT_FOUND を返す確率")
+    parser.add_argument("--seed", type=int, default=None, help="エラー注入の乱数シード")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--record", default=None, metavar="FILE", help="実 API に中継し、応答を FILE に保存する")
+    mode.add_argument("--replay", default=None, metavar="FILE", help="FILE に保存した応答を返す（無い組合せは生成）")
+    args = parser.parse_args(argv)
+
+    stand_in = DistanceMatrixStandIn(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        over_query_limit_rate=args.over_query_limit_rate, max_qps=args.max_qps,
+        element_quota=args.element_quota, element_error_rate=args.element_error_rate,
+        record=args.record, replay=args.replay, seed=args.seed,
+    )
+    server = make_stand_in_server(stand_in, args.host, args.port)
+    logger.info(f"起動しました: http://{args.host}:{server.server_address[1]} "
+                f"（config.yaml の google_maps.base_url に指定してください）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info(f"集計: {json.dumps(stand_in.stats)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
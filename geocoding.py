@@ -0,0 +1,139 @@
+"""
+住所 → 緯度経度（起点・終点住所の解決）
+
+次の順で解決し、同じ住所で二度ネットワークに問い合わせない。
+  1. config.yaml の geocoding.known_addresses（事業所など固定の住所）
+  2. 永続キャッシュ（geocoding.cache_path の JSON）
+  3. Google Maps Geocoding API（または google_maps.base_url の代替サーバ・client 引数）
+API で解決できた住所はキャッシュに追記する。
+
+  latlng, error = geocode("千葉県市原市白金町1-32", api_key=api_key)
+"""
+import json
+import os
+import threading
+import unicodedata
+
+import metrics
+from utils import get_config, create_maps_client, _warn
+
+_lock = threading.Lock()
+_cache = None
+_cache_path = None
+
+
+def normalize_address(address):
+    """全角・半角の揺れと空白を吸収したキャッシュのキー"""
+    text = unicodedata.normalize('NFKC', str(address or ''))
+    return "".join(text.split()).replace('−', '-').replace('‐', '-')
+
+
+def _config():
+    return get_config().get('geocoding') or {}
+
+
+def _resolve_cache_path():
+    path = _config().get('cache_path') or ''
+    if path and not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    return path
+
+
+def _load_cache():
+    global _cache, _cache_path
+    path = _resolve_cache_path()
+    if _cache is None or path != _cache_path:
+        _cache_path = path
+        _cache = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    _cache = json.load(f)
+            except (OSError, ValueError):
+                _cache = {}
+    return _cache
+
+
+def _save_cache():
+    if not _cache_path:
+        return
+    os.makedirs(os.path.dirname(_cache_path) or '.', exist_ok=True)
+    tmp = _cache_path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(_cache, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, _cache_path)
+
+
+def known_addresses():
+    return {normalize_address(k): (float(v[0]), float(v[1]))
+            for k, v in (_config().get('known_addresses') or {}).items()}
+
+
+def _lookup(key):
+    known = known_addresses()
+    if key in known:
+        return known[key], 'known'
+    with _lock:
+        cached = _load_cache().get(key)
+    if cached:
+        return (float(cached[0]), float(cached[1])), 'cache'
+    return None, None
+
+
+def geocode(address, api_key=None, client=None, warn=None):
+    """
+    address: 住所文字列
+    client: googlemaps.Client の代わりに使うもの（geocode メソッドを持つもの。distance_stub.StubGeocoder など）
+    戻り値: ((lat, lng), None) または (None, エラーメッセージ)
+    """
+    key = normalize_address(address)
+    with metrics.span('geocode', source=None) as sp:
+        if not key:
+            sp['error'] = 'empty'
+            return None, "住所が入力されていません。"
+
+        latlng, source = _lookup(key)
+        if latlng is not None:
+            sp['source'] = source
+            return latlng, None
+
+        if client is None and not api_key and not (get_config().get('google_maps') or {}).get('base_url'):
+            sp['error'] = 'no_provider'
+            return None, f"住所の座標がキャッシュに無く、APIキーも無いため解決できません: {address}"
+
+        sp['source'] = 'api'
+        try:
+            gmaps = client if client is not None else create_maps_client(api_key)
+            results = gmaps.geocode(address, language='ja', region='jp')
+        except Exception as e:
+            sp['error'] = type(e).__name__
+            _warn(warn, f"Google Maps Geocoding API エラー: {e}")
+            return None, f"住所を解決できません: {address}"
+
+        if not results:
+            sp['error'] = 'zero_results'
+            return None, f"住所が見つかりません: {address}"
+
+        location = results[0]['geometry']['location']
+        latlng = (float(location['lat']), float(location['lng']))
+        with _lock:
+            _load_cache()[key] = [latlng[0], latlng[1]]
+            _save_cache()
+        return latlng, None
+
+
+def default_depot(api_key=None, client=None, warn=None):
+    """
+    config.yaml の defaults.origin_address / destination_address（空欄なら起点と同じ）の座標
+    戻り値: (起点, 終点, None) または (None, None, エラーメッセージ)
+    """
+    defaults = get_config()['defaults']
+    origin_address = defaults.get('origin_address') or ''
+    destination_address = defaults.get('destination_address') or origin_address
+    origin, error = geocode(origin_address, api_key=api_key, client=client, warn=warn)
+    if error:
+        return None, None, error
+    destination, error = geocode(destination_address, api_key=api_key, client=client, warn=warn)
+    if error:
+        return None, None, error
+    return origin, destination, None
@@ -0,0 +1,255 @@
+"""
+顧客マスタの差分読み込みと版の保存
+
+毎朝アップロードし直すマスタはほとんど変わらないので、前回のマスタと顧客コードで突き合わせる。
+  - 追加・削除・変更の行を報告する
+  - 変わらない顧客は前回と同じ行ラベルを使う（TODAYリスト・距離行列などの参照が切れない）
+  - 読み込んだマスタは版として保存し（master_store.snapshot_dir）、比較・巻き戻しに使う
+  - 版はマスタの持ち主（担当営業員コード、無ければファイル名）ごとに分ける。
+    保存先はサーバ全体で共有なので、他の担当者のマスタと比べたり、その版に戻したりしない
+  - 前回と同じファイルなら解析せずに保存済みの版を返す
+
+  df, diff, error = load_master(uploaded_file, previous=st.session_state['master_df'], warn=st.warning)
+  diff -> {'version', 'source', 'master_source', 'added': 行ラベル, 'removed': 旧行ラベル, 'changed': 行ラベル,
+           'moved': 座標が変わった行ラベル, 'unchanged': 件数}
+"""
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+
+import pandas as pd
+
+import metrics
+from utils import get_config, load_customer_data
+
+_lock = threading.Lock()
+
+
+def _config():
+    return get_config().get('master_store') or {}
+
+
+def _snapshot_dir():
+    path = _config().get('snapshot_dir') or ''
+    if path and not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    return path
+
+
+def file_digest(file):
+    """アップロードされたファイルの内容のハッシュ（読み込み位置は先頭に戻す）"""
+    file.seek(0)
+    digest = hashlib.sha1(file.read()).hexdigest()
+    file.seek(0)
+    return digest
+
+
+def master_source(df, name=None):
+    """版の持ち主のキー。担当営業員コード（config の master_columns.sales_rep_code）の組み合わせ、無ければファイル名"""
+    column = (get_config().get('master_columns') or {}).get('sales_rep_code')
+    if column in df.columns:
+        reps = df[column].dropna().astype(str).str.strip().str.replace(r'\.0$', '', regex=True)
+        reps = sorted(set(reps) - {''})
+        if reps:
+            return 'rep:' + ','.join(reps)
+    return 'file:' + os.path.basename(name or '')
+
+
+def row_keys(df):
+    """行の突き合わせキー。顧客コード（文字列化・前後空白除去）＋同じコード内の出現順"""
+    codes = df['code'].astype(str).str.strip()
+    return codes + '#' + codes.groupby(codes).cumcount().astype(str)
+
+
+def _row_hashes(df, columns):
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+
+
+def diff_master(old_df, new_df):
+    """
+    old_df, new_df: compact_master 済みのマスタ
+    戻り値: (新マスタに振る行ラベル, 差分)。変わらない・変更された顧客は旧マスタの行ラベルを引き継ぐ
+    """
+    old_keys = pd.Series(old_df.index, index=row_keys(old_df).to_numpy())
+    new_keys = row_keys(new_df).to_numpy()
+    kept = pd.Index(new_keys).isin(old_keys.index)
+
+    labels = pd.Series(old_keys.reindex(new_keys).to_numpy(), dtype='float64')
+    next_label = int(old_df.index.max()) + 1 if len(old_df) else 0
+    labels[~kept] = range(next_label, next_label + int((~kept).sum()))
+    labels = labels.astype('int64').to_numpy()
+
+    # 共通の列の値を行ごとのハッシュで比べる（カテゴリの並びが違っても値が同じなら同じハッシュ）
+    columns = [c for c in new_df.columns if c in old_df.columns]
+    old_hash = pd.Series(_row_hashes(old_df, columns), index=old_df.index)
+    new_hash = _row_hashes(new_df, columns)
+    kept_labels = labels[kept]
+    changed = kept_labels[old_hash.loc[kept_labels].to_numpy() != new_hash[kept]]
+
+    old_pos = old_df.loc[kept_labels, ['lat', 'lng']].to_numpy()
+    new_pos = new_df.loc[kept, ['lat', 'lng']].to_numpy()
+    moved = kept_labels[(old_pos != new_pos).any(axis=1)]
+
+    diff = {
+        'added': labels[~kept].tolist(),
+        'removed': old_keys[~old_keys.index.isin(new_keys)].tolist(),
+        'changed': changed.tolist(),
+        'moved': moved.tolist(),
+        'unchanged': int(kept.sum()) - len(changed),
+    }
+    return labels, diff
+
+
+def reconcile(old_df, new_df):
+    """新マスタの行ラベルを旧マスタに合わせる。戻り値: (新マスタ, 差分)"""
+    if old_df is None or old_df.empty:
+        return new_df, {'added': new_df.index.tolist(), 'removed': [], 'changed': [], 'moved': [], 'unchanged': 0}
+    labels, diff = diff_master(old_df, new_df)
+    new_df = new_df.copy()
+    new_df.index = pd.Index(labels)
+    return new_df, diff
+
+
+# --- 版の保存（snapshot_dir/index.json に一覧、各版は pickle） ---
+
+def _read_index(directory):
+    path = os.path.join(directory, 'index.json')
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def _write_index(directory, entries):
+    path = os.path.join(directory, 'index.json')
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(entries, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+
+def list_snapshots(source=None):
+    """
+    保存済みの版（新しい順）: [{'version', 'created', 'rows', 'master_source', 'source_hash', 'added', 'removed', 'changed'}, ...]
+    source: master_source のキー。指定するとその持ち主の版だけを返す
+    """
+    directory = _snapshot_dir()
+    if not directory:
+        return []
+    with _lock:
+        entries = _read_index(directory)
+    if source is not None:
+        entries = [e for e in entries if e.get('master_source') == source]
+    return list(reversed(entries))
+
+
+def load_snapshot(version):
+    directory = _snapshot_dir()
+    path = os.path.join(directory, f"{version}.pkl") if directory else ''
+    if not path or not os.path.exists(path):
+        return None
+    return pd.read_pickle(path)
+
+
+def save_snapshot(df, source_hash=None, diff=None, source=None):
+    """
+    マスタを版として保存する。同じ持ち主（source）の直前の版と内容が同じなら保存せずその版を返す
+    保存先が未設定なら None
+    """
+    directory = _snapshot_dir()
+    if not directory:
+        return None
+    content_hash = hashlib.sha1(_row_hashes(df, list(df.columns)).tobytes()
+                                + df.index.to_numpy().tobytes()).hexdigest()
+    with _lock:
+        os.makedirs(directory, exist_ok=True)
+        entries = _read_index(directory)
+        own = [e for e in entries if e.get('master_source') == source]
+        if own and own[-1].get('content_hash') == content_hash:
+            if source_hash and own[-1].get('source_hash') != source_hash:
+                own[-1]['source_hash'] = source_hash
+                _write_index(directory, entries)
+            return own[-1]['version']
+
+        version = datetime.now().strftime('%Y%m%d-%H%M%S')
+        if any(e['version'] == version for e in entries):
+            version += f"-{len(entries)}"
+        path = os.path.join(directory, f"{version}.pkl")
+        df.to_pickle(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+        entries.append({
+            'version': version,
+            'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'rows': len(df),
+            'master_source': source,
+            'source_hash': source_hash,
+            'content_hash': content_hash,
+            **({k: len(diff[k]) for k in ('added', 'removed', 'changed')} if diff else {}),
+        })
+        # 同じ持ち主の古い版を削除
+        keep = max(1, int(_config().get('keep', 14)))
+        stale = [e['version'] for e in entries if e.get('master_source') == source][:-keep]
+        for old in stale:
+            try:
+                os.remove(os.path.join(directory, f"{old}.pkl"))
+            except OSError:
+                pass
+        _write_index(directory, [e for e in entries if e['version'] not in stale])
+    return version
+
+
+def _find_source(source_hash):
+    for entry in list_snapshots():
+        if entry.get('source_hash') == source_hash:
+            return entry['version']
+    return None
+
+
+def load_master(file, previous=None, warn=None):
+    """
+    file: アップロードされたファイル（name 属性と read/seek を持つもの）
+    previous: 今のマスタ（無い・空なら同じ持ち主の最新の版と比べる）
+    戻り値: (マスタ, 差分, None) または (None, None, エラーメッセージ)
+    """
+    with metrics.span('load_master', source=None) as sp:
+        source_hash = file_digest(file)
+        version = _find_source(source_hash)
+        new_df = load_snapshot(version) if version else None
+        if new_df is not None:
+            # 同じファイルを読み込んだ版がある（解析しない）
+            sp['source'] = 'snapshot'
+        else:
+            sp['source'] = 'file'
+            new_df, error = load_customer_data(file, warn=warn)
+            if error:
+                sp['error'] = 'load'
+                return None, None, error
+
+        source = master_source(new_df, getattr(file, 'name', None))
+        if previous is None or previous.empty:
+            latest = list_snapshots(source)
+            previous = load_snapshot(latest[0]['version']) if latest else None
+        df, diff = reconcile(previous, new_df)
+        diff['version'] = save_snapshot(df, source_hash, diff, source)
+        diff['source'] = sp['source']
+        diff['master_source'] = source
+        sp.update(rows=len(df), **{k: len(diff[k]) for k in ('added', 'removed', 'changed', 'moved')})
+        return df, diff, None
+
+
+def rollback(version, current=None):
+    """保存済みの版に戻す。戻り値: (マスタ, 差分) または (None, None)"""
+    df = load_snapshot(version)
+    if df is None:
+        return None, None
+    df, diff = reconcile(current, df)
+    diff['version'] = version
+    diff['source'] = 'snapshot'
+    diff['master_source'] = next((e.get('master_source') for e in list_snapshots() if e['version'] == version), None)
+    return df, diff
@@ -0,0 +1,100 @@
+import contextvars
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+# 工程ごとの計測（スパン）
+# 各スパンは dict のレコードとして
+#   - collect() で囲んだ範囲ではリストに集められ（画面の診断パネル用）
+#   - ロガー "visitplan.metrics" に JSON 1行として出力される
+# 顧客名・住所はログに残さない（要件定義書 11）。config.yaml の metrics.include_private で
+# デバッグ時のみ許可できる。
+
+logger = logging.getLogger("visitplan.metrics")
+
+PRIVATE_KEYS = {'name', 'customer_name', 'address', 'origin_address', 'destination_address'}
+
+_collector = contextvars.ContextVar('visitplan_metrics_collector', default=None)
+
+
+def _include_private():
+    from utils import get_config
+    return bool(get_config().get('metrics', {}).get('include_private', False))
+
+
+def _scrub(record):
+    if _include_private():
+        return record
+    return {k: v for k, v in record.items() if k not in PRIVATE_KEYS}
+
+
+def emit(record):
+    record = _scrub(record)
+    records = _collector.get()
+    if records is not None:
+        records.append(record)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+def event(name, **attrs):
+    """時間を持たない記録（API のタイルごとの結果など）"""
+    emit({'span': name, 'ts': time.time(), **attrs})
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    with span('optimize_route', stops=30) as sp:
+        ...
+        sp['iterations'] = 12
+    """
+    record = {'span': name, 'ts': time.time(), **attrs}
+    t0 = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        record['ms'] = round((time.perf_counter() - t0) * 1000, 2)
+        emit(record)
+
+
+@contextmanager
+def collect(records=None):
+    """範囲内で記録されたスパンをリストで受け取る（records を渡すとそのリストに追記）。入れ子なら外側にも渡す"""
+    if records is None:
+        records = []
+    outer = _collector.get()
+    start = len(records)
+    token = _collector.set(records)
+    try:
+        yield records
+    finally:
+        _collector.reset(token)
+        if outer is not None and outer is not records:
+            outer.extend(records[start:])
+
+
+def enable_json_log(path=None):
+    """スパンを JSON Lines で出力する（path 省略時は標準エラー出力）。重複登録はしない"""
+    target = path or '<stderr>'
+    for handler in logger.handlers:
+        if getattr(handler, '_visitplan_target', None) == target:
+            return
+    handler = logging.FileHandler(path, encoding='utf-8') if path else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    handler._visitplan_target = target
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def configure_from_config():
+    """config.yaml の metrics.log_path が設定されていれば JSON Lines 出力を有効にする"""
+    from utils import get_config
+    path = get_config().get('metrics', {}).get('log_path')
+    if path:
+        enable_json_log(path)
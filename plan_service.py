@@ -0,0 +1,383 @@
+"""
+訪問ルート計画のローカルサービス（標準ライブラリのみ）
+
+タブレットや配車システムから Streamlit を介さずに計画を取得するための JSON エンドポイント。
+
+  POST /plan    {"codes": [...], "must": [...], "origin": [lat, lng], "destination": [lat, lng], "departure": "09:00",
+                 "work_minutes": 15, "lunch_start": "12:00", "lunch_end": "13:00"}
+  GET  /health  キャッシュ・実行状況
+
+- 顧客マスタは起動時に1回だけ読み込む
+- 距離行列は地点列をキーに LRU キャッシュ
+- 並び替え・時刻割付は常駐のプロセスプールで実行
+- 同一内容の同時リクエストは1回の計算にまとめる
+- 応答には工程ごとの所要時間（timings）と Directions リンク（route_links）を含める
+
+距離プロバイダは client 引数で差し替え可能（--stub で distance_stub.StubDistanceClient）。
+HTTP の代替サーバ（python distance_stub.py）を使う場合は config.yaml の google_maps.base_url を指定する。
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import metrics
+from utils import get_config, load_customer_data, get_distance_matrix, solve_route, calculate_schedule, \
+    route_locations, matrix_legs, config_path
+from route_links import route_links
+from geocoding import default_depot
+
+logger = logging.getLogger("plan_service")
+
+
+class RequestError(ValueError):
+    pass
+
+
+# --- リクエストの各項目の検証（不正な値は RequestError） ---
+
+def _list_field(request, key):
+    value = request.get(key)
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        raise RequestError(f"{key} はリストで指定してください")
+    return value
+
+
+def _latlng_field(request, key, default):
+    value = request.get(key)
+    if value is None:
+        return default
+    if not isinstance(value, list) or len(value) != 2:
+        raise RequestError(f"{key} は [lat, lng] で指定してください")
+    try:
+        lat, lng = float(value[0]), float(value[1])
+    except (TypeError, ValueError):
+        raise RequestError(f"{key} は [lat, lng] で指定してください")
+    if not (math.isfinite(lat) and math.isfinite(lng) and -90 <= lat <= 90 and -180 <= lng <= 180):
+        raise RequestError(f"{key} の緯度経度が範囲外です")
+    return (lat, lng)
+
+
+def _time_field(request, key, default):
+    value = request.get(key, default)
+    try:
+        return datetime.strptime(value, '%H:%M').strftime('%H:%M')
+    except (TypeError, ValueError):
+        raise RequestError(f"{key} は HH:MM で指定してください")
+
+
+# ワーカープロセスで実行：並び替え → 時刻割付
+def _optimize_and_schedule(df_today, dist_matrix, time_matrix, must_indices, end_index, settings):
+    timings = {}
+    locations = list(range(len(dist_matrix)))
+
+    t0 = time.perf_counter()
+    solved = solve_route(locations, dist_matrix, must_visit_indices=must_indices, end_index=end_index)
+    optimized = solved['route']
+    timings['optimize'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    schedule = calculate_schedule(
+        [i - 1 for i in optimized], df_today,
+        settings['origin'][0], settings['origin'][1],
+        settings['departure'],
+        settings['work_minutes'],
+        settings['lunch_start'],
+        settings['lunch_end'],
+        destination=settings['destination'],
+        legs=matrix_legs(optimized, dist_matrix, time_matrix, end_index)
+    )
+    timings['schedule'] = time.perf_counter() - t0
+    quality = {'distance_m': round(solved['cost'], 1), 'lower_bound_m': round(solved['lower_bound'], 1),
+               'gap_pct': solved['gap_pct']}
+    return schedule, quality, timings
+
+
+# JSON に変換できない値（datetime, numpy）を変換
+def _to_json_value(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M')
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class PlanningService:
+
+    def __init__(self, master_df, api_key=None, client=None, workers=None, matrix_cache_size=None,
+                 default_origin=None, default_destination=None):
+        service_conf = get_config().get('service', {})
+        self.api_key = api_key
+        self.client = client
+        # origin を省略したリクエストの起点・終点（既定: config.yaml の defaults.origin_address / destination_address）
+        if default_origin is None:
+            default_origin, default_destination, error = default_depot(api_key=api_key)
+            if error:
+                logger.warning(f"既定の起点を解決できません（origin の指定が必須になります）: {error}")
+        self.default_origin = default_origin
+        self.default_destination = default_destination or default_origin
+        self.matrix_cache_size = matrix_cache_size or service_conf.get('matrix_cache_size', 256)
+
+        # 顧客コード → 行 の索引（文字列化・前後空白除去したコード）
+        master = master_df.assign(_code_key=master_df['code'].astype(str).str.strip())
+        self.master = master.drop_duplicates('_code_key').set_index('_code_key')
+
+        workers = workers if workers is not None else service_conf.get('workers', 2)
+        if workers > 1:
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=get_config,
+                                                initargs=(config_path(),))
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self._matrix_cache = OrderedDict()
+        self._matrix_lock = threading.Lock()
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self.stats = {'requests': 0, 'coalesced': 0, 'matrix_hits': 0, 'matrix_misses': 0}
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    # リクエストの検証と正規化（同一判定のキーにもなる）
+    def _normalize(self, request):
+        if not isinstance(request, dict):
+            raise RequestError("リクエストは JSON オブジェクトで指定してください")
+        defaults = get_config()['defaults']
+        codes = [str(c).strip() for c in _list_field(request, 'codes')]
+        if not codes:
+            raise RequestError("codes が空です")
+        if len(codes) > defaults['max_today_items']:
+            raise RequestError(f"codes は {defaults['max_today_items']} 件までです")
+        missing = [c for c in codes if c not in self.master.index]
+        if missing:
+            raise RequestError(f"マスタに無い顧客コード: {', '.join(missing[:10])}")
+
+        origin = _latlng_field(request, 'origin', None)
+        # 終点（省略時は起点に戻る。起点も省略した場合は既定の終点）
+        default_destination = origin if origin is not None else self.default_destination
+        if origin is None:
+            origin = self.default_origin
+        if origin is None:
+            raise RequestError("origin を指定してください")
+        destination = _latlng_field(request, 'destination', default_destination)
+
+        try:
+            work_minutes = int(request.get('work_minutes', defaults['work_minutes']))
+        except (TypeError, ValueError):
+            raise RequestError("work_minutes は整数で指定してください")
+        if work_minutes < 0:
+            raise RequestError("work_minutes は0以上で指定してください")
+
+        return {
+            'codes': codes,
+            'must': sorted({str(c).strip() for c in _list_field(request, 'must')} & set(codes)),
+            'origin': origin,
+            'destination': destination,
+            'departure': _time_field(request, 'departure', defaults['departure_time']),
+            'work_minutes': work_minutes,
+            'lunch_start': _time_field(request, 'lunch_start', defaults['lunch_start']),
+            'lunch_end': _time_field(request, 'lunch_end', defaults['lunch_end']),
+        }
+
+    # 距離行列・時間行列（地点列をキーにキャッシュ。API エラー時の直線距離はキャッシュしない）
+    def _matrix(self, locations):
+        key = tuple((round(loc['lat'], 6), round(loc['lng'], 6)) for loc in locations)
+        with self._matrix_lock:
+            if key in self._matrix_cache:
+                self._matrix_cache.move_to_end(key)
+                self.stats['matrix_hits'] += 1
+                return self._matrix_cache[key], True
+
+        with metrics.collect() as records:
+            matrices = get_distance_matrix(locations, api_key=self.api_key, client=self.client)
+
+        with self._matrix_lock:
+            self.stats['matrix_misses'] += 1
+            # API エラーで直線距離に切り替わった行列はキャッシュしない（復旧後も使い続けないように）
+            if any(r.get('fallback') for r in records if r.get('span') == 'get_distance_matrix'):
+                return matrices, False
+            self._matrix_cache[key] = matrices
+            while len(self._matrix_cache) > self.matrix_cache_size:
+                self._matrix_cache.popitem(last=False)
+        return matrices, False
+
+    def _plan(self, params):
+        timings = {}
+
+        t0 = time.perf_counter()
+        df_today = self.master.loc[params['codes']].reset_index(drop=True)
+        timings['lookup'] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        locations, end_index = route_locations(params['origin'], df_today['lat'], df_today['lng'], params['destination'])
+        (dist_matrix, time_matrix), cache_hit = self._matrix(locations)
+        timings['matrix'] = time.perf_counter() - t0
+
+        must = set(params['must'])
+        must_indices = [i + 1 for i, code in enumerate(params['codes']) if code in must]
+
+        t0 = time.perf_counter()
+        schedule, quality, worker_timings = self.executor.submit(
+            _optimize_and_schedule, df_today, dist_matrix, time_matrix, must_indices, end_index, params
+        ).result()
+        timings['worker'] = time.perf_counter() - t0
+        timings.update(worker_timings)
+
+        polyline = bool((get_config().get('route_links') or {}).get('polyline', False))
+        return {
+            'order': [str(item['code']).strip() for item in schedule if not item.get('terminal')],
+            'route_links': route_links([(params['origin'], schedule)], polyline=polyline)[0],
+            'schedule': [{k: _to_json_value(v) for k, v in item.items()} for item in schedule],
+            'quality': quality,
+            'matrix_cache_hit': cache_hit,
+            'timings': timings,
+        }
+
+    def handle(self, request):
+        """request: dict（POST /plan の本文）。戻り値: (HTTPステータス, 応答 dict)"""
+        started = time.perf_counter()
+        with self._inflight_lock:
+            self.stats['requests'] += 1
+        try:
+            params = self._normalize(request)
+        except RequestError as e:
+            return 400, {'error': str(e)}
+
+        # 同一内容の計算が進行中なら、その結果を待つ
+        key = json.dumps(params, sort_keys=True)
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+            else:
+                self.stats['coalesced'] += 1
+
+        if owner:
+            try:
+                future.set_result(self._plan(params))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._inflight_lock:
+                    self._inflight.pop(key, None)
+
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.exception("計画の作成に失敗しました")
+            return 500, {'error': str(e)}
+
+        response = dict(result)
+        response['coalesced'] = not owner
+        response['timings'] = dict(result['timings'], total=time.perf_counter() - started)
+        return 200, response
+
+    def health(self):
+        return {
+            'status': 'ok',
+            'master_rows': len(self.master),
+            'matrix_cache_entries': len(self._matrix_cache),
+            'inflight': len(self._inflight),
+            **self.stats,
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def _send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, self.server.service.health())
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/plan':
+            self._send_json(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except (ValueError, json.JSONDecodeError):
+            self._send_json(400, {'error': 'JSON を解釈できません'})
+            return
+        status, body = self.server.service.handle(request)
+        self._send_json(status, body)
+
+    def log_message(self, format, *args):
+        # 顧客情報を含まないアクセスログのみ
+        logger.info("%s %s", self.address_string(), format % args)
+
+
+def make_server(service, host=None, port=None):
+    service_conf = get_config().get('service', {})
+    server = ThreadingHTTPServer((host or service_conf.get('host', '127.0.0.1'),
+                                  port if port is not None else service_conf.get('port', 8765)), _Handler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description="訪問ルート計画サービス")
+    parser.add_argument("master", help="顧客マスタ (.xlsx / .csv)")
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None, help="常駐ワーカープロセス数")
+    parser.add_argument("--api-key", default=None, help="既定: 環境変数 GOOGLE_MAPS_API_KEY / config.yaml")
+    parser.add_argument("--stub", action="store_true", help="Google Maps の代わりにローカルの距離プロバイダを使う")
+    parser.add_argument("--config", default=None, help="設定ファイル（既定: config.yaml）")
+    args = parser.parse_args(argv)
+
+    config = get_config(args.config)
+    metrics.configure_from_config()
+    api_key = args.api_key or os.environ.get("GOOGLE_MAPS_API_KEY") or config.get('google_maps_api_key') or None
+
+    with open(args.master, 'rb') as f:
+        master_df, error = load_customer_data(f)
+    if error:
+        logger.error(f"顧客マスタを読み込めません: {error}")
+        return 1
+
+    client = None
+    if args.stub:
+        from distance_stub import StubDistanceClient
+        client = StubDistanceClient()
+
+    service = PlanningService(master_df, api_key=api_key, client=client, workers=args.workers)
+    server = make_server(service, args.host, args.port)
+    logger.info(f"{len(master_df)}件の顧客データで起動しました: http://{server.server_address[0]}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,325 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from utils import get_config, get_distance_matrix, optimize_route, route_lower_bound, optimality_gap, \
+    route_locations, route_distance, config_path, straight_line_matrix, distance_provider, matrix_legs
+
+# 複数ルート／複数日の計画
+# 選択された顧客を K ルート（または D 日）に分割し、各ルートを optimize_route で並び替える
+#   1. 起点＋全顧客の直線距離の行列を作成（全顧客の n^2 要素を API で取得しない）
+#   2. スイープ法 または 容量制約付き k-means で分割（作業量[分]を均等化）
+#   3. ルートごとに optimize_route を並列実行
+#   4. ルート間の付け替え（relocate）で仕上げ
+#   5. ルートごとに道路の距離行列を取得し、その行列で並び替え直す
+
+
+# 緯度経度を平面座標に変換（起点緯度での正距円筒近似）
+def _project(lats, lngs, origin):
+    x = (lngs - origin[1]) * np.cos(np.radians(origin[0]))
+    y = lats - origin[0]
+    return np.column_stack([x, y])
+
+
+# 各顧客の作業量見積もり（分）
+# 作業時間 + 最寄り顧客までの移動時間（ルート確定前の移動時間の近似）
+def estimate_workload(time_matrix, work_minutes):
+    n = len(work_minutes)
+    if n <= 1:
+        return np.asarray(work_minutes, dtype=float) + time_matrix[0, 1:] / 60
+    sub = time_matrix[1:, 1:].astype(float)
+    np.fill_diagonal(sub, np.inf)
+    return np.asarray(work_minutes, dtype=float) + sub.min(axis=1) / 60
+
+
+# スイープ法：起点からの方位角で並べ、作業量の累積で K 分割する
+def sweep_clusters(lats, lngs, origin, weights, k):
+    n = len(lats)
+    labels = np.zeros(n, dtype=int)
+    if n == 0 or k <= 1:
+        return labels
+
+    xy = _project(np.asarray(lats, dtype=float), np.asarray(lngs, dtype=float), origin)
+    angles = np.arctan2(xy[:, 1], xy[:, 0])
+    order = np.argsort(angles)
+
+    # 最も角度の開いている隙間から走査を始めると、境界が顧客の少ない方向に来る
+    sorted_angles = angles[order]
+    gaps = np.diff(np.concatenate([sorted_angles, sorted_angles[:1] + 2 * np.pi]))
+    order = np.roll(order, -((int(np.argmax(gaps)) + 1) % n))
+
+    w = np.asarray(weights, dtype=float)[order]
+    cum = np.cumsum(w)
+    target = cum[-1] / k if cum[-1] > 0 else 1.0
+    # 各顧客の作業量の中点がどの区間に入るかで割り当てる
+    labels[order] = np.minimum(((cum - w / 2) / target).astype(int), k - 1)
+    return labels
+
+
+# 容量制約付き k-means（作業量の上限 capacity を超えないように割り当てる）
+def kmeans_clusters(lats, lngs, origin, weights, k, capacity, init_labels=None, max_iter=20):
+    n = len(lats)
+    if n == 0 or k <= 1:
+        return np.zeros(n, dtype=int)
+
+    xy = _project(np.asarray(lats, dtype=float), np.asarray(lngs, dtype=float), origin)
+    w = np.asarray(weights, dtype=float)
+
+    if init_labels is None:
+        init_labels = sweep_clusters(lats, lngs, origin, w, k)
+    labels = np.asarray(init_labels, dtype=int).copy()
+    centers = np.zeros((k, 2))
+
+    for _ in range(max_iter):
+        for c in range(k):
+            members = labels == c
+            if members.any():
+                centers[c] = xy[members].mean(axis=0)
+
+        d = ((xy[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+
+        # 距離の近い (顧客, クラスタ) の組から容量の範囲で確定していく
+        new_labels = np.full(n, -1)
+        load = np.zeros(k)
+        for flat in np.argsort(d, axis=None):
+            i, c = divmod(int(flat), k)
+            if new_labels[i] >= 0:
+                continue
+            if load[c] + w[i] <= capacity:
+                new_labels[i] = c
+                load[c] += w[i]
+
+        # 容量に収まらなかった顧客は最も負荷の小さいクラスタへ
+        for i in np.where(new_labels < 0)[0]:
+            c = int(np.argmin(load))
+            new_labels[i] = c
+            load[c] += w[i]
+
+        if (new_labels == labels).all():
+            break
+        labels = new_labels
+
+    return labels
+
+
+# ルート（起点0を含まない行列インデックスのリスト）の距離合計（起点発）
+# end_index: 終点の行列インデックス（0 なら起点に戻る。None なら片道）。空のルートは 0
+def route_cost(route, dist_matrix, end_index=None):
+    if not route:
+        return 0.0
+    return route_distance(route, dist_matrix, end_index)
+
+
+# ルートの作業量（分）= 移動時間（終点までを含む） + 作業時間
+def route_workload(route, time_matrix, work_minutes, end_index=None):
+    travel_sec = route_cost(route, time_matrix, end_index)
+    return travel_sec / 60 + sum(work_minutes[node - 1] for node in route)
+
+
+# ルートの部分行列のインデックス（起点・訪問先・終点）と、部分行列での終点の位置
+def _sub_indices(nodes, end_index):
+    idx = [0] + list(nodes)
+    if end_index is None or end_index == 0:
+        return idx, end_index
+    return idx + [end_index], len(idx)
+
+
+# 並列実行用（プロセスプールから呼ばれるためトップレベルに置く）
+def _solve_cluster(args):
+    nodes, dist_matrix, end_index = args
+    if not nodes:
+        return []
+    idx, sub_end = _sub_indices(nodes, end_index)
+    sub = dist_matrix[np.ix_(idx, idx)]
+    order = optimize_route(idx, sub, end_index=sub_end)
+    return [idx[i] for i in order]
+
+
+def _solve_clusters(tasks, max_workers):
+    if max_workers and max_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(tasks)), initializer=get_config,
+                                 initargs=(config_path(),)) as executor:
+            return list(executor.map(_solve_cluster, tasks))
+    return [_solve_cluster(t) for t in tasks]
+
+
+# ルートの地点（起点・訪問先・終点）だけの道路の距離行列・時間行列
+# 直線距離で計算する場合（API キーなし）と訪問先が無い場合は取得せず、直線距離の行列から切り出す
+def _route_matrices(locations, route, end_index, line_matrices, api_key, warn):
+    idx, sub_end = _sub_indices(route, end_index)
+    if not route or distance_provider(api_key) == 'fallback':
+        dist_matrix, time_matrix = (m[np.ix_(idx, idx)] for m in line_matrices)
+    else:
+        dist_matrix, time_matrix = get_distance_matrix([locations[i] for i in idx], api_key=api_key, warn=warn)
+    return idx, sub_end, dist_matrix, time_matrix
+
+
+# ルート間の付け替え（relocate）
+# 距離合計が減り、受け入れ側の作業量が上限を超えない場合のみ移動する
+# end_index: 終点の行列インデックス（ルートの最後の顧客から終点までの区間も距離・作業量に含める）
+def relocate_between_routes(routes, dist_matrix, time_matrix, work_minutes, capacity, max_passes=10, end_index=None):
+    routes = [list(r) for r in routes]
+    loads = [route_workload(r, time_matrix, work_minutes, end_index) for r in routes]
+    moves = 0
+
+    for _ in range(max_passes):
+        improved = False
+        for a in range(len(routes)):
+            pos = 0
+            while pos < len(routes[a]):
+                ra = routes[a]
+                node = ra[pos]
+                prev = ra[pos - 1] if pos > 0 else 0
+                nxt = ra[pos + 1] if pos + 1 < len(ra) else end_index
+                # 取り除いたときの削減量（最後の1件を取り除いた空のルートは終点にも向かわない）
+                gain = dist_matrix[prev][node]
+                if nxt is not None:
+                    gain += dist_matrix[node][nxt]
+                    if len(ra) > 1:
+                        gain -= dist_matrix[prev][nxt]
+
+                best = None
+                for b in range(len(routes)):
+                    if b == a:
+                        continue
+                    rb = routes[b]
+                    for ins in range(len(rb) + 1):
+                        u = rb[ins - 1] if ins > 0 else 0
+                        v = rb[ins] if ins < len(rb) else end_index
+                        add = dist_matrix[u][node]
+                        add_sec = time_matrix[u][node]
+                        if v is not None:
+                            add += dist_matrix[node][v]
+                            add_sec += time_matrix[node][v]
+                            if rb:
+                                add -= dist_matrix[u][v]
+                                add_sec -= time_matrix[u][v]
+                        delta = add - gain
+                        if delta >= -1e-9 or (best is not None and delta >= best[0]):
+                            continue
+                        new_load = loads[b] + add_sec / 60 + work_minutes[node - 1]
+                        if new_load <= capacity:
+                            best = (delta, b, ins)
+
+                if best is not None:
+                    _, b, ins = best
+                    routes[b] = routes[b][:ins] + [node] + routes[b][ins:]
+                    routes[a] = ra[:pos] + ra[pos + 1:]
+                    loads[b] = route_workload(routes[b], time_matrix, work_minutes, end_index)
+                    loads[a] = route_workload(routes[a], time_matrix, work_minutes, end_index)
+                    moves += 1
+                    improved = True
+                    continue  # 同じ pos に詰めてきた次の顧客を調べる
+                pos += 1
+        if not improved:
+            break
+
+    return routes, moves
+
+
+# 複数ルート計画
+def plan_routes(df, origin, n_routes, method='sweep', api_key=None, max_workers=None, relocate=True, warn=None,
+                destination=None):
+    """
+    df: load_customer_data で読み込んだ顧客（lat, lng, WorkMinutes 列を使用）
+    origin: tuple (lat, lng)
+    destination: tuple (lat, lng)。各ルートの最後に向かう終点（None なら片道、起点と同じなら起点に戻る）
+    n_routes: ルート数（担当者数 または 日数）
+    method: 'sweep' または 'kmeans'
+    戻り値: ルートごとの dict のリスト。'indices' は df 内の位置（0オリジン）で、
+            calculate_schedule(route['indices'], df, ..., legs=route['legs']) にそのまま渡せる
+            'legs' はルートの行列による区間ごとの (距離m, 時間秒)
+    """
+    planner_conf = get_config().get('planner', {})
+    n = len(df)
+    k = max(1, min(int(n_routes), n)) if n else 1
+
+    lats = df['lat'].to_numpy(dtype=float)
+    lngs = df['lng'].to_numpy(dtype=float)
+    work_minutes = df['WorkMinutes'].to_numpy(dtype=float)
+
+    # 分割・付け替えは起点 + 全顧客（+ 終点）の直線距離の行列で行う
+    locations, end_index = route_locations(origin, lats, lngs, destination)
+    dist_matrix, time_matrix = straight_line_matrix(locations)
+
+    # 分割
+    weights = estimate_workload(time_matrix[:n + 1, :n + 1], work_minutes)
+    slack = planner_conf.get('balance_slack', 0.15)
+    capacity = weights.sum() / k * (1 + slack)
+
+    labels = sweep_clusters(lats, lngs, origin, weights, k)
+    if method == 'kmeans':
+        labels = kmeans_clusters(lats, lngs, origin, weights, k, capacity, init_labels=labels,
+                                 max_iter=planner_conf.get('kmeans_max_iter', 20))
+
+    clusters = [[int(i) + 1 for i in np.where(labels == c)[0]] for c in range(k)]
+
+    # ルートごとの最適化（並列）
+    if max_workers is None:
+        max_workers = planner_conf.get('max_workers', 4)
+    routes = _solve_clusters([(nodes, dist_matrix, end_index) for nodes in clusters], max_workers)
+
+    # ルート間の付け替えで仕上げる
+    moves = 0
+    before = [set(r) for r in routes]
+    if relocate and k > 1:
+        # 作業量の上限は、均等化の目標と現状の最大値の大きい方（悪化させない）
+        route_loads = [route_workload(r, time_matrix, work_minutes, end_index) for r in routes]
+        limit = max(capacity, max(route_loads))
+        routes, moves = relocate_between_routes(
+            routes, dist_matrix, time_matrix, work_minutes, limit,
+            max_passes=planner_conf.get('relocate_max_passes', 10), end_index=end_index
+        )
+
+    # ルートごとに道路の行列を取得し、その行列で並び替え直す（行列のインデックスはルート内の位置）
+    # 直線距離のままなら、付け替えで顧客が変わったルートだけを並び替え直す
+    matrices = [_route_matrices(locations, route, end_index, (dist_matrix, time_matrix), api_key, warn)
+                for route in routes]
+    resolve = [distance_provider(api_key) != 'fallback' or set(route) != before[i] for i, route in enumerate(routes)]
+    solved = iter(_solve_clusters([(list(range(1, len(route) + 1)), sub_dist, sub_end)
+                                   for route, (_, sub_end, sub_dist, _), again in zip(routes, matrices, resolve)
+                                   if again], max_workers))
+    orders = [next(solved) if again else list(range(1, len(route) + 1)) for route, again in zip(routes, resolve)]
+
+    results = []
+    for r_no, (order, (idx, sub_end, sub_dist, sub_time)) in enumerate(zip(orders, matrices)):
+        route = [idx[i] for i in order]
+        travel_min = route_cost(order, sub_time, sub_end) / 60
+        distance = route_cost(order, sub_dist, sub_end)
+        work_min = float(sum(work_minutes[node - 1] for node in route))
+        lower_bound = route_lower_bound(sub_dist, sub_end) if route else 0.0
+        results.append({
+            'route_no': r_no + 1,
+            'indices': [node - 1 for node in route],
+            'stops': len(route),
+            'distance_km': round(distance / 1000, 1),
+            'travel_min': int(round(travel_min)),
+            'work_min': int(round(work_min)),
+            'workload_min': int(round(travel_min + work_min)),
+            'relocate_moves': moves,
+            'gap_pct': optimality_gap(distance, lower_bound),
+            'legs': matrix_legs(order, sub_dist, sub_time, sub_end),
+        })
+    return results
+
+
+# 担当営業員コードごとに複数ルート計画を作成
+def plan_by_group(df, origin, n_routes, group_col=None, method='sweep', api_key=None, max_workers=None, warn=None,
+                  destination=None):
+    """
+    戻り値: {担当営業員コード: (担当分の df, plan_routes の結果)}
+    各 df は reset_index 済みなので、結果の 'indices' をそのまま使える
+    """
+    if group_col is None:
+        group_col = get_config()['master_columns'].get('sales_rep_code', '担当営業員コード')
+    if group_col not in df.columns:
+        return {None: (df.reset_index(drop=True),
+                       plan_routes(df.reset_index(drop=True), origin, n_routes, method=method,
+                                   api_key=api_key, max_workers=max_workers, warn=warn,
+                                   destination=destination))}
+
+    plans = {}
+    for key, group in df.groupby(group_col, sort=True, observed=True):
+        group = group.reset_index(drop=True)
+        plans[key] = (group, plan_routes(group, origin, n_routes, method=method,
+                                         api_key=api_key, max_workers=max_workers, warn=warn,
+                                         destination=destination))
+    return plans
@@ -0,0 +1,262 @@
+"""
+自動並び替えのバックグラウンド実行
+
+距離行列の取得と並び替えを、全セッションで共有するスレッドプールで実行する。
+Streamlit のスクリプトは待たずに進み、進捗の確認・キャンセルができる。
+
+- 結果は（顧客コード・MUST・座標・起点・終点・出発時刻・距離の取得元）の指紋でキャッシュし、
+  同じ内容で再度並び替えた場合は計算せずに返す。キャッシュは全セッションで共有するので、
+  座標の違うマスタや別の取得元（API・代替サーバ・直線距離）の結果は使い回さない
+- API エラーで直線距離に切り替わった結果はキャッシュしない
+- 同じ内容の計算が実行中なら新たに計算せず、その結果を待つジョブ（セッションごと）を返す
+- キャンセルはそのセッションの待ちだけをやめる。待っているセッションが無くなったら計算を止める
+  （協調的。タイル・2-opt の1周ごとに確認）
+
+  job = submit_optimization(df_today, origin, departure, api_key, destination=destination)
+  job.progress  -> {'stage': 'matrix', 'done': 3, 'total': 25}
+  job.cancel()
+  job.result()  -> {'order': 訪問順の顧客コード, 'codes', 'dist_matrix', 'time_matrix', 'end_index',
+                    'lower_bound', 'gap_pct', 'solve_ms'}
+                   （キャッシュ済みなら即座に返る。行列は手動並び替え時の再計算に使う）
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+
+import metrics
+from utils import get_config, get_distance_matrix, solve_route, route_locations, distance_provider, \
+    OperationCancelled
+
+_executor = None
+_lock = threading.Lock()
+_results = OrderedDict()   # 指紋 → 並び替え結果
+_running = {}              # 指紋 → 実行中の RouteJob
+
+
+def _jobs_config():
+    return get_config().get('jobs') or {}
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_jobs_config().get('max_workers', 4),
+                                           thread_name_prefix='route_job')
+        return _executor
+
+
+def stop_key(code):
+    """顧客コードの比較用キー（文字列化・前後空白除去）"""
+    return str(code).strip()
+
+
+def _rounded(latlng):
+    return None if latlng is None else [round(float(latlng[0]), 6), round(float(latlng[1]), 6)]
+
+
+def fingerprint(df_today, origin, departure, destination=None, provider=None):
+    """
+    並び替え結果を左右する入力の指紋。訪問候補の並び順には依存しない
+    df_today: code, MUST, lat, lng 列を使用
+    provider: 距離行列の取得元（utils.distance_provider）
+    """
+    stops = sorted((stop_key(code), bool(must), *_rounded((lat, lng)))
+                   for code, must, lat, lng in zip(df_today['code'], df_today['MUST'], df_today['lat'], df_today['lng']))
+    payload = {
+        'stops': stops,
+        'origin': _rounded(origin),
+        'destination': _rounded(destination),
+        'departure': departure,
+        'provider': provider,
+    }
+    return hashlib.sha1(json.dumps(payload, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class _Work:
+    """実行中の計算。同じ指紋で並び替えたセッションが共有する"""
+
+    def __init__(self, key):
+        self.key = key
+        self.future = None
+        self.progress = {'stage': 'queued', 'done': 0, 'total': None}
+        self.records = []    # 計測（metrics）のレコード
+        self.warnings = []   # st.warning はスクリプトのスレッドでしか使えないので溜めておく
+        self.waiters = 0     # 結果を待っているセッションの数（_lock で保護）
+        self._cancel = threading.Event()
+
+    def _report(self, stage, done, total=None):
+        if self._cancel.is_set():
+            raise OperationCancelled()
+        self.progress = {'stage': stage, 'done': done, 'total': total}
+
+
+class RouteJob:
+    """セッションごとの並び替えジョブ。共有の計算（_Work）の結果を待つ"""
+
+    def __init__(self, key, inputs, work=None):
+        self.key = key
+        self.inputs = inputs   # (origin, departure, destination, provider)。結果を反映する前の照合用
+        self.future = Future()
+        self.cached = False
+        self.started = time.time()
+        self.records = []    # 計測（metrics）のレコード。画面の診断情報に渡す
+        self.warnings = []
+        self._work = work
+        self._cancel = threading.Event()
+
+    @property
+    def progress(self):
+        if self._work is None or self.done():
+            return {'stage': 'done', 'done': 1, 'total': 1}
+        return self._work.progress
+
+    def cancel(self):
+        """このセッションの待ちをやめる。待っているセッションが無くなったら計算も止める"""
+        if self._cancel.is_set():
+            return
+        self._cancel.set()
+        self.future.cancel()
+        if self._work is not None:
+            _release(self._work)
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+
+def _release(work):
+    with _lock:
+        work.waiters -= 1
+        if work.waiters > 0:
+            return
+        if _running.get(work.key) is work:
+            del _running[work.key]
+    work._cancel.set()
+    work.future.cancel()
+
+
+# 共有の計算が終わったら、待っているセッションのジョブに結果を渡す（結果・計測・警告は複製）
+def _deliver(job, future):
+    if job.cancelled:
+        return
+    job.records = list(job._work.records)
+    job.warnings = list(job._work.warnings)
+    try:
+        if future.cancelled():
+            job.future.cancel()
+        elif future.exception() is not None:
+            job.future.set_exception(future.exception())
+        else:
+            job.future.set_result(dict(future.result()))
+    except InvalidStateError:
+        pass   # 同時にキャンセルされた
+
+
+def _run(work, df_today, origin, api_key, destination):
+    with metrics.collect(work.records):
+        # 終点が起点と同じなら起点に戻る（距離行列に地点を足さない）
+        locations, end_index = route_locations(origin, df_today['lat'], df_today['lng'], destination)
+        dist_matrix, time_matrix = get_distance_matrix(locations, api_key=api_key, warn=work.warnings.append,
+                                             progress=work._report)
+        fell_back = any(r.get('fallback') for r in work.records if r.get('span') == 'get_distance_matrix')
+        must_indices = [i + 1 for i, must in enumerate(df_today['MUST']) if must]
+        solved = solve_route(locations, dist_matrix, must_visit_indices=must_indices, progress=work._report,
+                             end_index=end_index)
+    codes = [stop_key(code) for code in df_today['code']]
+    return {
+        'order': [codes[i - 1] for i in solved['route']],
+        'codes': codes,   # 行列の 1..n 番目の地点の顧客コード（0 は起点）
+        'dist_matrix': dist_matrix,
+        'time_matrix': time_matrix,
+        'end_index': end_index,
+        'lower_bound': solved['lower_bound'],
+        'gap_pct': solved['gap_pct'],
+        'solve_ms': solved['solve_ms'],
+        'fallback': fell_back,   # API エラーで直線距離に切り替わった
+    }
+
+
+def _finish(work, future):
+    with _lock:
+        if _running.get(work.key) is work:
+            del _running[work.key]
+        if future.cancelled() or future.exception() is not None or future.result()['fallback']:
+            return
+        _results[work.key] = future.result()
+        _results.move_to_end(work.key)
+        while len(_results) > _jobs_config().get('cache_size', 128):
+            _results.popitem(last=False)
+
+
+def submit_optimization(df_today, origin, departure, api_key=None, destination=None):
+    """
+    df_today: build_today_df の結果（code, MUST, lat, lng 列を使用）
+    origin: (lat, lng)
+    destination: (lat, lng)。ルートの最後に固定する終点（None なら終点なし）
+    戻り値: このセッション用の RouteJob（キャッシュ済みなら結果が入っている。
+            同じ内容の計算が実行中なら、その結果を待つ）
+    """
+    inputs = (origin, departure, destination, distance_provider(api_key))
+    key = fingerprint(df_today, *inputs)
+    executor = _get_executor()
+    with _lock:
+        if key in _results:
+            _results.move_to_end(key)
+            job = RouteJob(key, inputs)
+            job.cached = True
+            job.future.set_result(dict(_results[key]))
+            return job
+        work = _running.get(key)
+        start = work is None
+        if start:
+            work = _Work(key)
+            # 呼び出し側の DataFrame は以後も変更され得るので、必要な列だけ複製して渡す
+            work.future = executor.submit(_run, work, df_today[['code', 'MUST', 'lat', 'lng']].copy(), origin,
+                                          api_key, destination)
+            _running[key] = work
+        work.waiters += 1
+        job = RouteJob(key, inputs, work)
+
+    # 終わっていればその場で呼ばれる（_finish は _lock を取るのでロックの外で登録する）
+    if start:
+        work.future.add_done_callback(lambda future: _finish(work, future))
+    work.future.add_done_callback(lambda future: _deliver(job, future))
+    return job
+
+
+def apply_order(today_list, codes, order):
+    """
+    today_list を並び替え結果（顧客コードの順）に並べ替える
+    codes: today_list と同じ順の顧客コード
+    """
+    by_code = {}
+    for item, code in zip(today_list, codes):
+        by_code.setdefault(stop_key(code), []).append(item)
+    return [by_code[code].pop(0) for code in order]
+
+
+def clear_cache():
+    with _lock:
+        _results.clear()
+
+
+def invalidate(codes):
+    """指定した顧客コードを含む並び替え結果を捨てる（マスタで座標が変わった時）"""
+    codes = {stop_key(code) for code in codes}
+    if not codes:
+        return 0
+    with _lock:
+        stale = [key for key, result in _results.items() if codes & set(result['codes'])]
+        for key in stale:
+            del _results[key]
+    return len(stale)
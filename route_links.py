@@ -0,0 +1,143 @@
+"""
+訪問ルートの Google Maps Directions リンク（RouteMapURL）と経路の polyline
+
+Directions の経由地は最大23件（route_links.max_waypoints）なので、長いルートは複数の URL に分割する。
+分割した URL は前の URL の終点を次の URL の起点にしてつなげる。
+複数の計画をまとめて渡すと、座標の文字列化・分割位置の計算を全計画で1回に行う。
+
+polyline（Encoded Polyline Algorithm）は連続する2地点ごとの区間をキャッシュするので、
+同じ区間を含む計画を何度出力しても同じ区間を符号化し直さない。
+
+  urls = route_map_urls([(origin, schedule), ...])        # 計画ごとの URL のリスト
+  links = route_links([(origin, schedule), ...], polyline=True)
+  links[0] -> [{'url': ..., 'legs': 24, 'polyline': ...}, ...]
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from utils import get_config
+
+DIRECTIONS_URL = "https://www.google.com/maps/dir/?api=1"
+
+_lock = threading.Lock()
+_segments = OrderedDict()   # (緯度1, 経度1, 緯度2, 経度2)（1e-5 度単位）→ 符号化した区間
+
+
+def _config():
+    return get_config().get('route_links') or {}
+
+
+def schedule_points(origin, schedule):
+    """起点＋訪問先（帰着行があれば終点）の緯度経度 (n, 2)"""
+    points = [(float(origin[0]), float(origin[1]))]
+    points.extend((float(item['lat']), float(item['lng'])) for item in schedule)
+    return np.array(points, dtype=float).reshape(-1, 2)
+
+
+def _chunks(n_points, max_waypoints):
+    """n 地点のルートを分割した (開始, 終了) の位置。1本あたり max_waypoints + 1 区間"""
+    step = max_waypoints + 1
+    starts = np.arange(0, n_points - 1, step)
+    return starts, np.minimum(starts + step, n_points - 1)
+
+
+def _split(plans, max_waypoints):
+    """全計画の地点をつないだ配列と、計画ごとの分割位置（連結後の位置）"""
+    paths = [schedule_points(origin, schedule) for origin, schedule in plans]
+    coords = np.concatenate(paths) if paths else np.empty((0, 2))
+    offsets = np.concatenate([[0], np.cumsum([len(p) for p in paths])])
+    bounds = []
+    for offset, path in zip(offsets, paths):
+        if len(path) < 2:
+            bounds.append([])
+            continue
+        starts, ends = _chunks(len(path), max_waypoints)
+        bounds.append(list(zip((starts + offset).tolist(), (ends + offset).tolist())))
+    return coords, bounds
+
+
+def _format_coords(coords):
+    # 全地点を1回で "lat,lng" にする
+    return np.char.add(np.char.add(np.char.mod('%.6f', coords[:, 0]), ','), np.char.mod('%.6f', coords[:, 1]))
+
+
+def _url(text, start, end):
+    url = f"{DIRECTIONS_URL}&origin={text[start]}&destination={text[end]}&travelmode=driving"
+    if end - start > 1:
+        url += "&waypoints=" + "%7C".join(text[start + 1:end])
+    return url
+
+
+def route_map_urls(plans, max_waypoints=None):
+    """
+    plans: [(起点 (lat, lng), schedule_data), ...]（schedule_data は calculate_schedule の結果）
+    戻り値: 計画ごとの Directions URL のリスト（訪問先が無い計画は空リスト）
+    """
+    return [[link['url'] for link in links] for links in route_links(plans, max_waypoints=max_waypoints)]
+
+
+def route_links(plans, polyline=False, max_waypoints=None):
+    """route_map_urls と同じ分割で、URL・区間数（・polyline）の dict を返す"""
+    if max_waypoints is None:
+        max_waypoints = int(_config().get('max_waypoints', 23))
+    coords, bounds = _split(plans, max_waypoints)
+    text = _format_coords(coords) if len(coords) else []
+    e5 = np.round(coords * 1e5).astype(np.int64) if polyline else None
+
+    result = []
+    for plan_bounds in bounds:
+        links = []
+        for start, end in plan_bounds:
+            link = {'url': _url(text, start, end), 'legs': end - start}
+            if polyline:
+                link['polyline'] = _encode_path(e5[start:end + 1])
+            links.append(link)
+        result.append(links)
+    return result
+
+
+# --- Encoded Polyline Algorithm ---
+
+def _encode_value(value):
+    value = ~(value << 1) if value < 0 else value << 1
+    chunks = []
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+    return "".join(chunks)
+
+
+def _encode_path(e5):
+    """e5: 1e-5 度単位の整数座標 (n, 2)。区間（前の地点からの差分）はキャッシュから引く"""
+    first = e5[0]
+    parts = [_encode_value(int(first[0])) + _encode_value(int(first[1]))]
+    keys = [tuple(pair) for pair in np.hstack([e5[:-1], e5[1:]]).tolist()]
+    cache_size = int(_config().get('polyline_cache_size', 10000))
+    with _lock:
+        for key in keys:
+            segment = _segments.get(key)
+            if segment is None:
+                segment = _encode_value(key[2] - key[0]) + _encode_value(key[3] - key[1])
+                _segments[key] = segment
+                if len(_segments) > cache_size:
+                    _segments.popitem(last=False)
+            else:
+                _segments.move_to_end(key)
+            parts.append(segment)
+    return "".join(parts)
+
+
+def encode_polyline(points):
+    """points: [(lat, lng), ...] の Encoded Polyline"""
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if not len(points):
+        return ""
+    return _encode_path(np.round(points * 1e5).astype(np.int64))
+
+
+def clear_cache():
+    with _lock:
+        _segments.clear()
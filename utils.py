@@ -1,19 +1,70 @@
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
-import googlemaps
 from math import radians, cos, sin, asin, sqrt
-import openpyxl
-from openpyxl.styles import Font, Alignment, Border, Side
-import streamlit as st
-import yaml
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+# googlemaps / openpyxl / yaml は使う関数の中で import する（起動・ワーカー生成を軽くするため）
+
+logger = logging.getLogger(__name__)
 
 # 設定の読み込み
-def load_config():
-    with open('config.yaml', 'r', encoding='utf-8') as file:
+# 既定は utils.py と同じフォルダの config.yaml（環境変数 VISIT_PLAN_CONFIG で変更可）
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')
+
+_config_path = os.path.abspath(os.environ.get('VISIT_PLAN_CONFIG') or DEFAULT_CONFIG_PATH)
+_config_cache = {}
+_config_lock = threading.Lock()
+
+def load_config(path=None):
+    import yaml
+    with open(path or _config_path, 'r', encoding='utf-8') as file:
         return yaml.safe_load(file)
 
-CONFIG = load_config()
+# 設定を1回だけ読み込んで返す
+# path を指定した場合はその設定を読み込み、以降の get_config() の既定にする
+def get_config(path=None):
+    global _config_path
+    with _config_lock:
+        if path is not None:
+            _config_path = os.path.abspath(path)
+        if _config_path not in _config_cache:
+            _config_cache[_config_path] = load_config(_config_path)
+        return _config_cache[_config_path]
+
+# 今の設定ファイルのパス。プロセスプールのワーカーに渡す
+# （spawn / forkserver のワーカーは親の get_config(path) を引き継がないため）
+#   ProcessPoolExecutor(initializer=get_config, initargs=(config_path(),))
+def config_path():
+    return _config_path
+
+# 旧来の utils.CONFIG 参照用（初回アクセス時に読み込む）
+def __getattr__(name):
+    if name == 'CONFIG':
+        return get_config()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# 警告の通知先
+# エンジン側は Streamlit に依存しない。画面では warn=st.warning を渡し、
+# CLI 等では logging に流す
+# 進捗コールバック（progress）から送出して処理を中断する（route_jobs.py のキャンセル）
+class OperationCancelled(Exception):
+    pass
+
+def _progress(progress, stage, done, total=None):
+    if progress is not None:
+        progress(stage, done, total)
+
+def _warn(warn, message):
+    if warn is None:
+        logger.warning(message)
+    else:
+        warn(message)
 
 # ハーサイン距離（代替手段）
 def haversine(lon1, lat1, lon2, lat2):
@@ -27,7 +78,17 @@ def haversine(lon1, lat1, lon2, lat2):
     return c * r
 
 # データの読み込みと前処理
-def load_customer_data(file):
+def load_customer_data(file, warn=None):
+    file_name = getattr(file, 'name', '')
+    with metrics.span('load_customer_data', format='csv' if file_name.endswith('.csv') else 'xlsx') as sp:
+        df, error = _load_customer_data(file, warn, sp)
+        if error:
+            sp['error'] = 'missing_columns' if error.startswith('必須列') else 'exception'
+        else:
+            sp['rows'] = len(df)
+    return df, error
+
+def _load_customer_data(file, warn, sp):
     try:
         if file.name.endswith('.csv'):
             # 文字コード自動判別の簡易実装（utf-8-sig -> shift_jis -> cp932）
@@ -45,7 +106,8 @@ def load_customer_data(file):
             df = pd.read_excel(file, header=1)
         
         # 列名マッピング
-        col_map = CONFIG['master_columns']
+        config = get_config()
+        col_map = config['master_columns']
         # 必要な列が存在するかチェック
         required_cols = [col_map['customer_code'], col_map['customer_name'], col_map['latlng']]
         missing = [c for c in required_cols if c not in df.columns]
@@ -76,7 +138,8 @@ def load_customer_data(file):
         # 緯度経度が欠損している行を除外
         invalid_rows = df[df['lat'].isna() | df['lng'].isna()]
         if not invalid_rows.empty:
-            st.warning(f"{len(invalid_rows)}行のデータで緯度経度が不正なため除外されました。")
+            sp['dropped_rows'] = len(invalid_rows)
+            _warn(warn, f"{len(invalid_rows)}行のデータで緯度経度が不正なため除外されました。")
             df = df.dropna(subset=['lat', 'lng'])
             
         # 売上がNaNの場合は0埋め
@@ -87,40 +150,117 @@ def load_customer_data(file):
             
         # 作業時間の欠損処理（configのデフォルト値で埋める）
         if 'WorkMinutes' in df.columns:
-             df['WorkMinutes'] = pd.to_numeric(df['WorkMinutes'], errors='coerce').fillna(CONFIG['defaults']['work_minutes'])
+             df['WorkMinutes'] = pd.to_numeric(df['WorkMinutes'], errors='coerce').fillna(config['defaults']['work_minutes'])
         else:
-            df['WorkMinutes'] = CONFIG['defaults']['work_minutes']
+            df['WorkMinutes'] = config['defaults']['work_minutes']
             
         # 入場不可時間帯の欠損処理（空文字にする）
         if 'NoEntryTime' not in df.columns:
             df['NoEntryTime'] = None
             
-        return df, None
+        return compact_master(df, col_map), None
         
     except Exception as e:
         return None, str(e)
 
+# 読み込んだマスタを省メモリの型にそろえる
+# セッションごとに保持されるため、不要な元の列（緯度経度の文字列・取引履歴など）は落とす
+MASTER_COLUMNS = ['code', 'name', 'sales', 'address', 'WorkMinutes', 'NoEntryTime', 'lat', 'lng']
+MASTER_CATEGORY_KEYS = ['prefecture', 'city', 'sales_rep_code', 'open_close']
+
+def compact_master(df, col_map):
+    category_cols = [col_map[k] for k in MASTER_CATEGORY_KEYS if col_map.get(k) in df.columns]
+    df = df[[c for c in MASTER_COLUMNS if c in df.columns] + category_cols].reset_index(drop=True)
+
+    # 顧客コード：前後の空白を除去。先頭ゼロの無い数字だけなら int64、それ以外は category
+    codes = df['code'].astype(str).str.strip()
+    is_int = codes.str.fullmatch(r'[1-9][0-9]{0,17}|0')
+    if is_int.all():
+        df['code'] = codes.astype('int64')
+    else:
+        df['code'] = codes.astype('category')
+
+    df['lat'] = df['lat'].astype('float32')
+    df['lng'] = df['lng'].astype('float32')
+    df['sales'] = df['sales'].astype('int32')
+    df['WorkMinutes'] = df['WorkMinutes'].round().astype('int32')
+    df['NoEntryTime'] = df['NoEntryTime'].astype('category')
+    for col in category_cols:
+        df[col] = df[col].astype('category')
+    return df
+
+# TODAYリスト（マスタの行ラベル＋MUST・作業時間）から対象顧客の DataFrame を作る
+# today_list: [{'row': マスタの index, 'MUST': bool, 'WorkMinutes': int（省略時はマスタの値）}, ...]
+def build_today_df(master_df, today_list):
+    df = master_df.loc[[item['row'] for item in today_list]].reset_index(names='row')
+    df.insert(0, 'MUST', [bool(item.get('MUST', False)) for item in today_list])
+    overrides = [item.get('WorkMinutes') for item in today_list]
+    if any(w is not None for w in overrides):
+        df['WorkMinutes'] = np.array([w if w is not None else m for w, m in zip(overrides, df['WorkMinutes'])],
+                                     dtype='int32')
+    return df
+
+# API キーの無いローカル代替サーバ用（googlemaps.Client は "AIza" で始まるキーを要求する）
+STAND_IN_API_KEY = "AIza-local-stand-in"
+
+# googlemaps.Client の作成（config.yaml の google_maps セクション）
+# base_url を指定すると distance_stub.py の代替サーバなど Google 以外に接続する
+def create_maps_client(api_key=None, base_url=None):
+    import googlemaps
+    conf = get_config().get('google_maps') or {}
+    base_url = (base_url or conf.get('base_url') or '').rstrip('/')
+    kwargs = {
+        'queries_per_second': conf.get('queries_per_second', 60),
+        'retry_over_query_limit': conf.get('retry_over_query_limit', True),
+        'retry_timeout': conf.get('retry_timeout', 60),
+    }
+    if base_url:
+        kwargs['base_url'] = base_url
+    return googlemaps.Client(key=api_key or STAND_IN_API_KEY, **kwargs)
+
+def _maps_base_url():
+    return (get_config().get('google_maps') or {}).get('base_url') or ''
+
+# 距離行列の取得元: 'stub'（client 指定）, 'stand_in'（代替サーバ）, 'api', 'fallback'（直線距離）
+def distance_provider(api_key=None, client=None):
+    if client is not None:
+        return 'stub'
+    if _maps_base_url():
+        return 'stand_in'
+    return 'api' if api_key else 'fallback'
+
 # 距離行列の取得（Google Maps API または 直線距離）
-def get_distance_matrix(locations, api_key=None, origin=None):
+def get_distance_matrix(locations, api_key=None, origin=None, warn=None, client=None, progress=None):
     """
     locations: list of dict {'lat': float, 'lng': float} (index 0 is origin if origin is None)
     origin: tuple (lat, lng) or str (address) if provided separately
+    warn: 警告の通知先（None の場合は logging）
+    client: googlemaps.Client の代わりに使う距離プロバイダ（distance_matrix メソッドを持つもの。テスト・ローカル検証用）
+    progress: progress('matrix', 完了数, 全体数) で進捗を通知（OperationCancelled を送出すると中断）
     """
+    with metrics.span('get_distance_matrix', stops=len(locations), provider=distance_provider(api_key, client),
+                      tiles=0, elements=0, element_fallbacks=0) as sp:
+        return _get_distance_matrix(locations, api_key, warn, client, progress, sp)
+
+def _get_distance_matrix(locations, api_key, warn, client, progress, sp):
     n = len(locations)
     dist_matrix = np.zeros((n, n)) # メートル
     time_matrix = np.zeros((n, n)) # 秒
     
-    # APIキーがある場合
-    if api_key:
+    # APIキー（または差し替えのプロバイダ・代替サーバ）がある場合
+    if api_key or client is not None or sp['provider'] == 'stand_in':
         try:
-            gmaps = googlemaps.Client(key=api_key)
+            gmaps = client if client is not None else create_maps_client(api_key)
             
+            filled = np.zeros((n, n), dtype=bool)
+
             # 緯度経度リストの作成 (API用)
             coords = [(loc['lat'], loc['lng']) for loc in locations]
             
             # API制限対策（要素数100以下/リクエスト、推奨25以下）
             # 6x6 = 36 要素ずつ処理
             batch_size = 6
+            total_tiles = ((n + batch_size - 1) // batch_size) ** 2
             
             for i in range(0, n, batch_size):
                 origin_batch = coords[i : i + batch_size]
@@ -130,6 +270,7 @@ def get_distance_matrix(locations, api_key=None, origin=None):
                     
                     # APIコール
                     # departure_time=datetime.now() で現在の交通状況を考慮
+                    t0 = time.perf_counter()
                     response = gmaps.distance_matrix(
                         origins=origin_batch,
                         destinations=dest_batch,
@@ -138,6 +279,16 @@ def get_distance_matrix(locations, api_key=None, origin=None):
                     )
                     
                     rows = response.get('rows', [])
+                    
+                    # タイルごとの計測（所要時間・要素数・ステータス）
+                    elements_count = len(origin_batch) * len(dest_batch)
+                    not_ok = sum(1 for row in rows for el in row.get('elements', []) if el.get('status') != 'OK')
+                    metrics.event('distance_matrix_tile', origin_offset=i, dest_offset=j,
+                                  ms=round((time.perf_counter() - t0) * 1000, 2),
+                                  elements=elements_count, status=response.get('status'), not_ok=not_ok)
+                    sp['tiles'] += 1
+                    sp['elements'] += elements_count
+                    _progress(progress, 'matrix', sp['tiles'], total_tiles)
                     for r_idx, row in enumerate(rows):
                         elements = row.get('elements', [])
                         for c_idx, element in enumerate(elements):
@@ -155,35 +306,212 @@ def get_distance_matrix(locations, api_key=None, origin=None):
                                 
                                 dist_matrix[global_row][global_col] = dist_val
                                 time_matrix[global_row][global_col] = dur_val
+                                filled[global_row][global_col] = True
             
+            # 取得できなかった要素（ZERO_RESULTS 等）だけ直線距離で補う
+            missing = [(r, c) for r, c in zip(*np.nonzero(~filled)) if r != c]
+            if missing:
+                sp['element_fallbacks'] = len(missing)
+                for r, c in missing:
+                    dist_matrix[r][c], time_matrix[r][c] = _fallback_element(locations[r], locations[c])
+                _warn(warn, f"Google Maps API で取得できなかった区間 {len(missing)}件を直線距離（30km/h）で計算しました。")
+
             # 成功したらここでリターン（フォールバックに行かせない）
             return dist_matrix, time_matrix
             
+        except OperationCancelled:
+            raise
         except Exception as e:
-            st.warning(f"Google Maps API エラー: {e}。直線距離（30km/h）で計算します。")
+            sp['fallback'] = True
+            sp['api_error'] = type(e).__name__
+            _warn(warn, f"Google Maps API エラー: {e}。直線距離（30km/h）で計算します。")
     
     # 直線距離（フォールバック）
-    # 速度仮定: 30km/h = 500m/min = 8.33m/s
-    speed_mps = 30 * 1000 / 3600
-    
     for i in range(n):
+        _progress(progress, 'matrix', i, n)
         for j in range(n):
             if i == j:
                 continue
-            d_km = haversine(locations[i]['lng'], locations[i]['lat'], 
-                             locations[j]['lng'], locations[j]['lat'])
-            dist_matrix[i][j] = d_km * 1000 # m
-            time_matrix[i][j] = (d_km * 1000) / speed_mps # seconds
-            
-            # APIが使えた場合は上書きするロジックをここに書く
+            dist_matrix[i][j], time_matrix[i][j] = _fallback_element(locations[i], locations[j])
             
     return dist_matrix, time_matrix
 
+# 直線距離による1区間の (距離m, 時間秒)
+# 速度仮定: 30km/h = 500m/min = 8.33m/s
+def _fallback_element(a, b):
+    speed_mps = 30 * 1000 / 3600
+    d_m = haversine(a['lng'], a['lat'], b['lng'], b['lat']) * 1000
+    return d_m, d_m / speed_mps
+
+# 起点・訪問先・終点から optimize_route 用の地点リストと end_index を作る
+# 終点が起点と同じ（または None）なら地点を増やさない（end_index は 0 / None）
+def route_locations(origin, lats, lngs, destination=None):
+    locations = [{'lat': float(origin[0]), 'lng': float(origin[1])}] + \
+                [{'lat': float(lat), 'lng': float(lng)} for lat, lng in zip(lats, lngs)]
+    if destination is None:
+        return locations, None
+    if round(float(destination[0]), 6) == round(float(origin[0]), 6) and \
+            round(float(destination[1]), 6) == round(float(origin[1]), 6):
+        return locations, 0
+    locations.append({'lat': float(destination[0]), 'lng': float(destination[1])})
+    return locations, len(locations) - 1
+
+# 最小全域木（NumPy による Prim 法。O(n^2)）。戻り値: (重み, 各点の次数)
+def _mst(w):
+    n = len(w)
+    degree = np.zeros(n, dtype=int)
+    if n <= 1:
+        return 0.0, degree
+    # 木に入れた点の列を inf にして、以降の候補から外す
+    w = w.copy()
+    w[:, 0] = np.inf
+    best = w[0].copy()
+    parent = np.zeros(n, dtype=int)
+    total = 0.0
+    for _ in range(n - 1):
+        j = int(best.argmin())
+        total += best[j]
+        degree[j] += 1
+        degree[parent[j]] += 1
+        w[:, j] = np.inf
+        best[j] = np.inf
+        closer = w[j] < best
+        best[closer] = w[j][closer]
+        parent[closer] = j
+    return float(total), degree
+
+# 1-tree（点0を除いた最小全域木 + 点0からの2辺）。partner があれば点0の1辺は partner への辺に固定
+def _one_tree(w, partner):
+    weight, sub_degree = _mst(w[1:, 1:])
+    degree = np.concatenate([[0], sub_degree])
+    if partner is None:
+        ends = np.argsort(w[0, 1:])[:2] + 1
+    else:
+        others = np.delete(np.arange(1, len(w)), partner - 1)
+        ends = [partner, others[int(np.argmin(w[0, others]))]]
+    for j in ends:
+        weight += w[0][j]
+        degree[j] += 1
+    degree[0] = 2
+    return weight, degree
+
+# 最近傍法による巡回の長さ（劣勾配法の歩幅に使う上界）
+def _nearest_neighbour_tour(w, partner):
+    rest = set(range(1, len(w))) - {partner}
+    current, total = 0, 0.0
+    while rest:
+        nxt = min(rest, key=lambda j: w[current][j])
+        total += w[current][nxt]
+        rest.remove(nxt)
+        current = nxt
+    if partner is not None:
+        total += w[current][partner]
+        current = partner
+    return total + w[current][0]
+
+# ルート長の下界（起点0・全訪問先・終点を通る経路は、どれもこの値以上）
+# 経路を起点に戻る巡回に直し、Held-Karp 下界（1-tree + 各点のペナルティを劣勾配法で調整）を求める
+#   end_index=0: そのまま巡回
+#   終点あり: 長さ0 の「終点→起点」の辺を1-tree に必ず含める
+#   片道: 全訪問先と距離0 のダミー点を終点として加える
+# iterations: 劣勾配法の反復回数（None なら config の optimizer.bound_iterations。0 なら単純な 1-tree）
+# 非対称の行列は min(d[i][j], d[j][i]) で対称にして使う
+def route_lower_bound(dist_matrix, end_index=None, iterations=None):
+    d = np.asarray(dist_matrix, dtype=float)
+    w = np.minimum(d, d.T)
+    n = len(w)
+    if n <= 1:
+        return 0.0
+    if n == 2:
+        return float(2 * w[0][1] if end_index == 0 else w[0][1])
+    if iterations is None:
+        iterations = int((get_config().get('optimizer') or {}).get('bound_iterations', 20))
+
+    partner = end_index or None
+    if end_index is None:
+        w = np.pad(w, ((0, 1), (0, 1)))
+        partner = n
+    elif partner is not None:
+        # 「終点→起点」の辺は実際には走らないので長さ0
+        w = w.copy()
+        w[0][partner] = w[partner][0] = 0.0
+    upper = _nearest_neighbour_tour(w, partner)
+
+    pi = np.zeros(len(w))
+    best = 0.0
+    step_scale, stale = 1.0, 0
+    for _ in range(iterations + 1):
+        weight, degree = _one_tree(w + pi[:, None] + pi[None, :], partner)
+        bound = weight - 2 * pi.sum()
+        if bound > best + 1e-9:
+            best, stale = bound, 0
+        else:
+            stale += 1
+            if stale >= 2:
+                step_scale, stale = step_scale / 2, 0
+        g = degree - 2
+        norm = float((g * g).sum())
+        if norm == 0 or upper <= best:
+            # 1-tree が巡回になった（下界 = 最適値）
+            break
+        pi = pi + step_scale * (upper - bound) / norm * g
+    return float(best)
+
+# 下界に対するギャップ(%)
+def optimality_gap(cost, lower_bound):
+    if lower_bound <= 0:
+        return 0.0
+    return round(max(0.0, (cost - lower_bound) / lower_bound * 100), 1)
+
 # ルート最適化（Nearest Insertion + 2-opt）
 # must_visit_indices: 訪問必須（かつ最初に行く）箇所のインデックスリスト（0オリジン、depot除くindex）
-def optimize_route(locations, dist_matrix, must_visit_indices=None):
+# progress: 2-opt の1周ごとに progress('optimize', 周回数) で通知（OperationCancelled を送出すると中断）
+# end_index: 終点（最後に必ず向かう地点）の locations のインデックス。0 なら起点に戻る。None なら終点なし
+def optimize_route(locations, dist_matrix, must_visit_indices=None, progress=None, end_index=None):
+    return solve_route(locations, dist_matrix, must_visit_indices, progress=progress, end_index=end_index)['route']
+
+# optimize_route と同じ並び替えに、結果の評価を付けて返す
+# 戻り値: {'route': 訪問順, 'cost': 総距離, 'lower_bound': 下界, 'gap_pct': ギャップ(%), 'solve_ms': 所要時間,
+#          'stopped_early': ギャップがしきい値（config の optimizer.gap_threshold_pct）を下回って打ち切ったか}
+def solve_route(locations, dist_matrix, must_visit_indices=None, progress=None, end_index=None, gap_threshold_pct=None):
+    if gap_threshold_pct is None:
+        gap_threshold_pct = (get_config().get('optimizer') or {}).get('gap_threshold_pct', 0)
+    stops = len(locations) - 1 - (1 if end_index else 0)
+    t0 = time.perf_counter()
+    with metrics.span('optimize_route', stops=stops, must=len(must_visit_indices) if must_visit_indices else 0,
+                      end_point=end_index is not None) as sp:
+        lower_bound = route_lower_bound(dist_matrix, end_index)
+        route = _optimize_route(locations, dist_matrix, must_visit_indices, progress, end_index,
+                                lower_bound * (1 + gap_threshold_pct / 100) if gap_threshold_pct else None, sp)
+        cost = route_distance(route, dist_matrix, end_index)
+        sp['lower_bound'] = round(lower_bound, 1)
+        sp['gap_pct'] = optimality_gap(cost, lower_bound)
+    return {
+        'route': route,
+        'cost': cost,
+        'lower_bound': lower_bound,
+        'gap_pct': sp['gap_pct'],
+        'solve_ms': round((time.perf_counter() - t0) * 1000, 2),
+        'stopped_early': sp.get('stopped_early', False),
+    }
+
+# 2-opt で入れ替えとみなす最小の改善（m）。浮動小数の誤差で同じ入れ替えを繰り返さない
+TWO_OPT_EPSILON = 1e-6
+
+# 経路の累積距離。forward[k]: route[0]→route[k] の長さ、backward[k]: 各辺を逆向きに走った場合の長さ
+def _path_prefix(route, dist_matrix):
+    forward = [0.0]
+    backward = [0.0]
+    for a, b in zip(route, route[1:]):
+        forward.append(forward[-1] + dist_matrix[a][b])
+        backward.append(backward[-1] + dist_matrix[b][a])
+    return forward, backward
+
+# target_cost: この距離以下になったら 2-opt を打ち切る（None なら改善が無くなるまで）
+def _optimize_route(locations, dist_matrix, must_visit_indices, progress, end_index, target_cost, sp):
     n = len(locations)
     # 0番目は起点（Depot）
+    # end_index がある場合、終点はルートの最後に固定し、並び替えの対象にしない
     
     # MUST箇所の処理
     # MUST箇所を先に訪問するルートを構築
@@ -212,7 +540,7 @@ def optimize_route(locations, dist_matrix, must_visit_indices=None):
     route = [0] + visited_must
     
     # 残りの箇所
-    unvisited = set(range(1, n)) - set(visited_must)
+    unvisited = set(range(1, n)) - set(visited_must) - {end_index}
     
     # Nearest Neighbor で残りを追加 (Nearest Insertion の簡易版として実装中)
     while unvisited:
@@ -237,6 +565,11 @@ def optimize_route(locations, dist_matrix, must_visit_indices=None):
         nearest_node = min(unvisited, key=lambda x: dist_matrix[last_node][x])
         route.append(nearest_node)
         unvisited.remove(nearest_node)
+    
+    # 終点を最後に固定（2-opt は終点の手前までを入れ替え、終点への区間のコストも評価する）
+    if end_index is not None:
+        route.append(end_index)
+    movable_end = len(route) - (1 if end_index is not None else 0)
         
     # 2-opt (MUST箇所の順序は守るべきか？ -> MUSTは「今日の1番目に行く」など順序指定の意味合いが強い
     # しかし、要件は「この顧客は今日の1番目に行く」という【MUST】設定。
@@ -251,32 +584,107 @@ def optimize_route(locations, dist_matrix, must_visit_indices=None):
     # must_visit_indices がある場合、その長さ分は固定（Depot(1) + Must(k)）
     fixed_len = 1 + (len(must_visit_indices) if must_visit_indices else 0)
     
+    initial_cost = sum(dist_matrix[a][b] for a, b in zip(route, route[1:]))
+    sp['iterations'] = 0
+    # 周回数の上限（通常はこれより前に改善が無くなる）
+    max_passes = int((get_config().get('optimizer') or {}).get('max_passes', 100))
+    
     improved = True
     while improved:
         improved = False
+        if target_cost is not None and sum(dist_matrix[a][b] for a, b in zip(route, route[1:])) <= target_cost:
+            sp['stopped_early'] = True
+            break
+        if sp['iterations'] >= max_passes:
+            sp['max_passes_reached'] = True
+            break
+        sp['iterations'] += 1
+        _progress(progress, 'optimize', sp['iterations'])
         # fixed_len 以降の要素のみ最適化対象
         start_idx = max(1, fixed_len) 
-        if start_idx >= len(route) - 1:
+        if start_idx >= movable_end - 1:
             break
+        # 区間を反転すると中の辺の向きも変わる（非対称の行列では長さが変わる）ので、
+        # 順方向・逆方向の累積距離で反転前後の区間の長さを求める
+        forward, backward = _path_prefix(route, dist_matrix)
             
-        for i in range(start_idx, len(route) - 2):
-            for j in range(i + 1, len(route)):
+        for i in range(start_idx, movable_end - 2):
+            for j in range(i + 1, movable_end):
                 if j - i == 1: continue 
                 # 現在のコスト
                 d1 = dist_matrix[route[i-1]][route[i]]
-                d2 = dist_matrix[route[j]][route[(j+1)%len(route)]] if j+1 < len(route) else 0
+                d2 = dist_matrix[route[j]][route[j+1]] if j+1 < len(route) else 0
                 # 交換後のコスト
                 d3 = dist_matrix[route[i-1]][route[j]]
-                d4 = dist_matrix[route[i]][route[(j+1)%len(route)]] if j+1 < len(route) else 0
+                d4 = dist_matrix[route[i]][route[j+1]] if j+1 < len(route) else 0
+                inner_before = forward[j] - forward[i]
+                inner_after = backward[j] - backward[i]
                 
-                if d1 + d2 > d3 + d4:
+                if d1 + d2 + inner_before - (d3 + d4 + inner_after) > TWO_OPT_EPSILON:
                     route[i:j+1] = reversed(route[i:j+1])
+                    forward, backward = _path_prefix(route, dist_matrix)
                     improved = True
                     
-    return route[1:] # 起点を除く訪問順のインデックスリスト
+    final_cost = sum(dist_matrix[a][b] for a, b in zip(route, route[1:]))
+    sp['initial_cost'] = round(float(initial_cost), 1)
+    sp['final_cost'] = round(float(final_cost), 1)
+    sp['improvement'] = round(float(initial_cost - final_cost), 1)
+    
+    return route[1:movable_end] # 起点・終点を除く訪問順のインデックスリスト
 
 # スケジュール計算
-def calculate_schedule(route_indices, df_today, origin_lat, origin_lng, start_time_str, work_min, lunch_start_str, lunch_end_str):
+# 1件分の到着・終了時刻（入場不可時間帯・昼休憩を考慮）
+def _visit_times(current_time, travel_min, work_duration, no_entry_val, lunch_start, lunch_end):
+    arrival_time = current_time + timedelta(minutes=travel_min)
+    
+    # 入場不可時間帯のチェック
+    # NoEntryTime: "12:00-13:00" string or similar
+    if no_entry_val and isinstance(no_entry_val, str) and '-' in no_entry_val:
+        try:
+            start_str, end_str = no_entry_val.split('-')
+            # 今日の日付と結合
+            ne_start = datetime.strptime(f"{datetime.now().date()} {start_str.strip()}", "%Y-%m-%d %H:%M")
+            ne_end = datetime.strptime(f"{datetime.now().date()} {end_str.strip()}", "%Y-%m-%d %H:%M")
+            
+            # 到着時刻が入場不可時間帯に含まれる場合、終了まで待機
+            if ne_start <= arrival_time < ne_end:
+                arrival_time = ne_end
+        except:
+            pass # パースエラー時は無視
+    
+    # 昼休憩判定
+    # 到着が昼休憩にかかる -> 休憩終了まで待機
+    if lunch_start <= arrival_time < lunch_end:
+        arrival_time = lunch_end
+    
+    finish_time = arrival_time + timedelta(minutes=work_duration)
+    
+    # 作業中に昼休憩にかかる -> 休憩分後ろ倒し（非常に簡易的な実装）
+    # 到着は休憩前だが、終了が休憩開始を過ぎる場合
+    if arrival_time < lunch_start and finish_time > lunch_start:
+        # 休憩時間を挟む
+        finish_time += (lunch_end - lunch_start)
+    return arrival_time, finish_time
+
+# destination: (lat, lng) を渡すと、最後に終点への帰着行（'terminal': True）を追加する
+# legs: 各区間の (距離[m], 所要時間[秒]) のリスト（訪問順。終点があれば最後に終点への区間）。
+#       距離行列で並び替えた場合は matrix_legs で作って渡す（画面のプレビューと同じ時刻になる）。
+#       省略時は直線距離・30km/h で計算する
+def calculate_schedule(route_indices, df_today, origin_lat, origin_lng, start_time_str, work_min, lunch_start_str, lunch_end_str,
+                       destination=None, legs=None):
+    with metrics.span('calculate_schedule', stops=len(route_indices), end_point=destination is not None,
+                      legs='matrix' if legs is not None else 'straight_line'):
+        return _calculate_schedule(route_indices, df_today, origin_lat, origin_lng, start_time_str, work_min,
+                                   lunch_start_str, lunch_end_str, destination, legs)
+
+# 距離行列・時間行列から calculate_schedule の legs を作る
+# order: 訪問順の行列インデックス（0 は起点）。end_index: 終点の行列インデックス（None なら終点なし）
+def matrix_legs(order, dist_matrix, time_matrix, end_index=None):
+    path = [0] + list(order) + ([end_index] if end_index is not None else [])
+    return [(float(dist_matrix[a][b]), float(time_matrix[a][b])) for a, b in zip(path, path[1:])]
+
+def _calculate_schedule(route_indices, df_today, origin_lat, origin_lng, start_time_str, work_min, lunch_start_str, lunch_end_str,
+                        destination, legs):
     # route_indices: df_today 内の index ではなく、0オリジンの順序
     # df_today: 選択されたデータフレーム
     
@@ -299,42 +707,18 @@ def calculate_schedule(route_indices, df_today, origin_lat, origin_lng, start_ti
         row = df_today.iloc[idx]
         
         # 移動計算
-        dist_km = haversine(prev_lng, prev_lat, row['lng'], row['lat'])
-        travel_sec = (dist_km * 1000) / speed_mps
+        if legs is not None:
+            dist_km = legs[i][0] / 1000
+            travel_sec = legs[i][1]
+        else:
+            dist_km = haversine(prev_lng, prev_lat, row['lng'], row['lat'])
+            travel_sec = (dist_km * 1000) / speed_mps
         travel_min = int(travel_sec / 60)
         
-        arrival_time = current_time + timedelta(minutes=travel_min)
-        
-        # 入場不可時間帯のチェック
-        # NoEntryTime: "12:00-13:00" string or similar
-        no_entry_val = row.get('NoEntryTime')
-        if no_entry_val and isinstance(no_entry_val, str) and '-' in no_entry_val:
-            try:
-                start_str, end_str = no_entry_val.split('-')
-                # 今日の日付と結合
-                ne_start = datetime.strptime(f"{datetime.now().date()} {start_str.strip()}", "%Y-%m-%d %H:%M")
-                ne_end = datetime.strptime(f"{datetime.now().date()} {end_str.strip()}", "%Y-%m-%d %H:%M")
-                
-                # 到着時刻が入場不可時間帯に含まれる場合、終了まで待機
-                if ne_start <= arrival_time < ne_end:
-                    arrival_time = ne_end
-            except:
-                pass # パースエラー時は無視
-        
-        # 昼休憩判定
-        # 到着が昼休憩にかかる -> 休憩終了まで待機
-        if lunch_start <= arrival_time < lunch_end:
-            arrival_time = lunch_end
-        
         # 作業終了予定
         work_duration = int(row.get('WorkMinutes', work_min))
-        finish_time = arrival_time + timedelta(minutes=work_duration)
-        
-        # 作業中に昼休憩にかかる -> 休憩分後ろ倒し（非常に簡易的な実装）
-        # 到着は休憩前だが、終了が休憩開始を過ぎる場合
-        if arrival_time < lunch_start and finish_time > lunch_start:
-            # 休憩時間を挟む
-            finish_time += (lunch_end - lunch_start)
+        arrival_time, finish_time = _visit_times(current_time, travel_min, work_duration, row.get('NoEntryTime'),
+                                                 lunch_start, lunch_end)
             
         schedule.append({
             'seq': i + 1,
@@ -355,63 +739,230 @@ def calculate_schedule(route_indices, df_today, origin_lat, origin_lng, start_ti
         prev_lat = row['lat']
         prev_lng = row['lng']
         total_sales += row['sales']
+    
+    # 終点への帰着
+    if destination is not None:
+        if legs is not None:
+            dist_km = legs[len(route_indices)][0] / 1000
+            travel_min = int(legs[len(route_indices)][1] / 60)
+        else:
+            dist_km = haversine(prev_lng, prev_lat, destination[1], destination[0])
+            travel_min = int((dist_km * 1000) / speed_mps / 60)
+        arrival_time = current_time + timedelta(minutes=travel_min)
+        schedule.append({
+            'seq': len(schedule) + 1,
+            'code': '',
+            'name': '帰着',
+            'address': '',
+            'sales': 0,
+            'arrival_time': arrival_time,
+            'finish_time': arrival_time,
+            'work_min': 0,
+            'travel_min': travel_min,
+            'travel_dist': round(dist_km, 1),
+            'lat': destination[0],
+            'lng': destination[1],
+            'terminal': True
+        })
         
     return schedule
 
+# 直線距離の距離行列・時間行列（API を使わない。30km/h）
+def straight_line_matrix(locations):
+    lat = np.radians([float(loc['lat']) for loc in locations])
+    lng = np.radians([float(loc['lng']) for loc in locations])
+    dlat = lat[:, None] - lat[None, :]
+    dlng = lng[:, None] - lng[None, :]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin(dlng / 2) ** 2
+    dist_m = 2 * np.arcsin(np.sqrt(np.minimum(a, 1.0))) * 6371 * 1000
+    return dist_m, dist_m / (30 * 1000 / 3600)
+
+# 訪問順（locations のインデックス）の総距離(m)。end_index があれば終点への区間を含む
+def route_distance(order, dist_matrix, end_index=None):
+    path = [0] + list(order) + ([end_index] if end_index is not None else [])
+    return float(sum(dist_matrix[a][b] for a, b in zip(path, path[1:])))
+
+# 手動で並び替えた時の再計算（距離行列を引くだけの O(n)。API は呼ばない）
+# order: 訪問順の locations のインデックス
+# work_minutes, no_entry_times: order と同じ並びの作業時間(分)・入場不可時間帯
+# 戻り値: (各訪問先の {'arrival_time', 'finish_time', 'travel_min', 'travel_dist'} のリスト,
+#          {'distance_km', 'travel_min', 'end_time'})
+def reschedule(order, dist_matrix, time_matrix, work_minutes, no_entry_times, start_time_str, lunch_start_str, lunch_end_str,
+               end_index=None):
+    today = datetime.now().date()
+    current_time = datetime.strptime(f"{today} {start_time_str}", "%Y-%m-%d %H:%M")
+    lunch_start = datetime.strptime(f"{today} {lunch_start_str}", "%Y-%m-%d %H:%M")
+    lunch_end = datetime.strptime(f"{today} {lunch_end_str}", "%Y-%m-%d %H:%M")
+
+    rows = []
+    prev = 0
+    total_m = 0.0
+    total_min = 0
+    for node, work, no_entry in zip(order, work_minutes, no_entry_times):
+        travel_min = int(time_matrix[prev][node] / 60)
+        arrival_time, finish_time = _visit_times(current_time, travel_min, int(work), no_entry, lunch_start, lunch_end)
+        rows.append({
+            'arrival_time': arrival_time,
+            'finish_time': finish_time,
+            'travel_min': travel_min,
+            'travel_dist': round(float(dist_matrix[prev][node]) / 1000, 1),
+        })
+        total_m += float(dist_matrix[prev][node])
+        total_min += travel_min
+        current_time = finish_time
+        prev = node
+
+    if end_index is not None:
+        travel_min = int(time_matrix[prev][end_index] / 60)
+        total_m += float(dist_matrix[prev][end_index])
+        total_min += travel_min
+        current_time = current_time + timedelta(minutes=travel_min)
+
+    return rows, {'distance_km': round(total_m / 1000, 1), 'travel_min': total_min, 'end_time': current_time}
+
 # Excel出力
-def create_excel(schedule_data):
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "VisitPlan"
-    
-    headers = ["対象日付", "順番", "顧客コード", "顧客名", "住所", "作業時間(分)", 
-               "到着時刻", "終了時刻", "移動時間(分)", "移動距離(km)", "売上見込(円)", 
-               "メモ", "GoogleMapURL"]
-    
-    ws.append(headers)
-    
-    today_str = datetime.now().strftime('%Y-%m-%d')
-    
-    # Directions URL作成のためのWaypoint構築
-    waypoints = [f"{item['lat']},{item['lng']}" for item in schedule_data]
+# openpyxl の書き込み専用（ストリーミング）モードで出力する。
+# 列幅はセルを後から走査せず、書き込む値から計算する。
+EXCEL_HEADERS = ["対象日付", "順番", "顧客コード", "顧客名", "住所", "作業時間(分)",
+                 "到着時刻", "終了時刻", "移動時間(分)", "移動距離(km)", "売上見込(円)",
+                 "メモ", "GoogleMapURL", "RouteMapURL"]
+
+# 列ごとのセル書式（None は標準。整数は標準のままで数値セルになる）
+EXCEL_NUMBER_FORMATS = ['yyyy-mm-dd', None, None, None, None, None,
+                        'yyyy-mm-dd hh:mm', 'yyyy-mm-dd hh:mm', None, '0.0', '#,##0',
+                        None, None, None]
+
+EXCEL_MAX_COLUMN_WIDTH = 80
+
+# numpy の数値は Python の数値に変換（openpyxl のセル型判定のため）
+def _excel_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+# 表示幅（全角は2文字分）
+def _display_width(value):
+    if value is None:
+        return 0
+    if isinstance(value, datetime):
+        return 16  # yyyy-mm-dd hh:mm
+    text = str(value)
+    if text.isascii():
+        return len(text)
+    return sum(2 if ord(ch) > 0xFF else 1 for ch in text)
+
+# 1件分の訪問予定を行データ（値のリスト）に変換
+# route_urls: ルート全体の Directions リンク（経由地の上限で分割されたもの）。1行目に RouteMapURL, RouteMapURL2, ... として出す
+def _plan_rows(schedule_data, route_urls=()):
+    if schedule_data:
+        target_date = schedule_data[0]['arrival_time'].date()
+    else:
+        target_date = datetime.now().date()
     
-    for item in schedule_data:
+    for i, item in enumerate(schedule_data):
         # 個別Google Map URL
         gmap_url = f"https://www.google.com/maps/search/?api=1&query={item['lat']},{item['lng']}"
         
-        row = [
-            today_str,
+        yield [
+            target_date,
             item['seq'],
-            item['code'],
+            _excel_value(item['code']),
             item['name'],
             item['address'],
-            item['work_min'],
-            item['arrival_time'].strftime('%H:%M'),
-            item['finish_time'].strftime('%H:%M'),
-            item['travel_min'],
-            item['travel_dist'],
-            item['sales'],
+            _excel_value(item['work_min']),
+            item['arrival_time'],
+            item['finish_time'],
+            _excel_value(item['travel_min']),
+            _excel_value(item['travel_dist']),
+            _excel_value(item['sales']),
             "", # メモ
-            gmap_url
-            # route_url (削除)
+            gmap_url,
+            *(route_urls if i == 0 else [""] * len(route_urls))
         ]
+
+# 1件分の訪問予定を書き込み専用ブックのシートとして追加
+def _write_plan_sheet(wb, title, schedule_data, route_urls=()):
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, Alignment
+    from openpyxl.utils import get_column_letter
+    
+    ws = wb.create_sheet(title=title)
+    route_urls = list(route_urls) or [""]
+    headers = EXCEL_HEADERS + [f"RouteMapURL{n}" for n in range(2, len(route_urls) + 1)]
+    
+    # 行データを作りながら列幅を計算する
+    widths = [_display_width(h) for h in headers]
+    rows = []
+    for row in _plan_rows(schedule_data, route_urls):
+        for col, value in enumerate(row):
+            w = _display_width(value)
+            if w > widths[col]:
+                widths[col] = w
+        rows.append(row)
+    
+    # 書き込み専用モードでは列幅は行より先に設定する
+    for col, w in enumerate(widths):
+        ws.column_dimensions[get_column_letter(col + 1)].width = min(w + 2, EXCEL_MAX_COLUMN_WIDTH)
+    
+    header_font = Font(bold=True)
+    header_alignment = Alignment(horizontal='center')
+    header = []
+    for h in headers:
+        cell = WriteOnlyCell(ws, value=h)
+        cell.font = header_font
+        cell.alignment = header_alignment
+        header.append(cell)
+    ws.append(header)
+    
+    formatted_cols = [(col, fmt) for col, fmt in enumerate(EXCEL_NUMBER_FORMATS) if fmt]
+    for row in rows:
+        for col, fmt in formatted_cols:
+            if row[col] is not None and row[col] != "":
+                cell = WriteOnlyCell(ws, value=row[col])
+                cell.number_format = fmt
+                row[col] = cell
         ws.append(row)
-        
-    # スタイル調整
-    for cell in ws[1]:
-        cell.font = Font(bold=True)
-        cell.alignment = Alignment(horizontal='center')
-        
-    for col in ws.columns:
-        max_length = 0
-        column = col[0].column_letter
-        for cell in col:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except:
-                pass
-        adjusted_width = (max_length + 2)
-        ws.column_dimensions[column].width = adjusted_width
-        
+
+def create_excel(schedule_data, origin=None):
+    """訪問予定表のブック（書き込み専用。save は1回のみ可能）。origin を渡すと RouteMapURL を出力する"""
+    return create_excel_multi([("VisitPlan", schedule_data)], origin=origin)
+
+# 複数の訪問予定を1ブックにまとめる（1予定 = 1シート）
+# plans: list of (シート名, schedule_data)
+# origin: 起点 (lat, lng)。全予定の RouteMapURL をまとめて作る（None なら RouteMapURL は空欄）
+def create_excel_multi(plans, origin=None):
+    import openpyxl
+    from route_links import route_map_urls
+    with metrics.span('create_excel', sheets=len(plans), rows=sum(len(p[1]) for p in plans)) as sp:
+        if origin is not None:
+            urls = route_map_urls([(origin, schedule_data) for _, schedule_data in plans])
+            sp['route_urls'] = sum(len(u) for u in urls)
+        else:
+            urls = [[] for _ in plans]
+        wb = openpyxl.Workbook(write_only=True)
+        titles = []
+        for (sheet_name, schedule_data), route_urls in zip(plans, urls):
+            title = _sheet_title(sheet_name, titles)
+            titles.append(title)
+            _write_plan_sheet(wb, title, schedule_data, route_urls)
     return wb
+
+# ブックを xlsx のバイト列にする（ダウンロード用）
+def excel_bytes(wb):
+    import io
+    output = io.BytesIO()
+    wb.save(output)
+    return output.getvalue()
+
+# Excel のシート名制約（31文字、使用不可文字、重複）に合わせる
+def _sheet_title(name, existing):
+    title = str(name)
+    for ch in '[]:*?/\\':
+        title = title.replace(ch, '_')
+    title = title[:31] or "VisitPlan"
+    base, n = title, 2
+    while title in existing:
+        suffix = f"_{n}"
+        title = base[:31 - len(suffix)] + suffix
+        n += 1
+    return title